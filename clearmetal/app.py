@@ -2,10 +2,10 @@
 """The main ClearMetal code challenge Celery app. 
 
 Run with this signature
-    celery -A clearmetal.app.app worker --pidfile=app.pid -n app -Q app,canvas
+    celery -A clearmetal.app.app worker --pidfile=app.pid -n app@%h -Q app,canvas
 
 or for a scheduled run
-    celery -A clearmetal.app.app worker --pidfile=app.pid -B -n app -Q app,canvas
+    celery -A clearmetal.app.app worker --pidfile=app.pid -B -n app@%h -Q app,canvas
 
 """
 
@@ -42,12 +42,20 @@ def beat_init_signal(sender=None, body=None, **kwargs):
     l.info('The ClearMetal scheduling app {} with beat schedule is starting.'.format(sender))
 
 
+@celery.signals.celeryd_init.connect
+def start_log_aggregator(sender=None, conf=None, **kwargs):
+    # Start the app log aggregator in the worker's main process, before the pool forks, so every process in the pool
+    # inherits its queue. Clients and the CLI importing the app write to the log file directly.
+    if config.logging['app']['handler_type'] == 'queue':
+        clearmetal.utilities.get_log_aggregator(**config.logging['app'])
+
+
 @celery.signals.celeryd_init.connect
 @clearmetal.utilities.logger(logger_spec=config.logging['app'])
 def celeryd_init_signal(sender=None, conf=None, **kwargs):
     l = kwargs.get('logger')
     l.info('The ClearMetal scheduling app {} has started.'.format(sender))
-    l.info(conf.CELERYBEAT_SCHEDULE)
+    l.info(conf.beat_schedule)
 
 
 @celery.signals.worker_shutdown.connect
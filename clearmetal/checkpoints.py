@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""Durable checkpoints so interrupted pipelines can resume where they left off.
+
+Checkpoints are keyed by the 'pipeline_id' carried in the task metadata. The result of every finished segment and
+every finished phase is saved, and re-running a pipeline with the same id skips any work that was already done.
+
+"""
+
+import hashlib
+import json
+import os
+
+import config
+
+
+class DiskCheckpoints(object):
+    """Stores checkpoints as JSON files on the local disk.
+
+    Args:
+        directory (str): The directory to store the checkpoints in.
+
+    """
+
+    def __init__(self, directory='checkpoints', **kwargs):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, *key.split('/')) + '.json'
+
+    def get(self, key):
+        """Loads a checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+
+        Returns:
+            tuple: Whether the checkpoint was found, and its value.
+
+        """
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as checkpoint_file:
+                return True, json.load(checkpoint_file)
+        except FileNotFoundError:
+            return False, None
+
+    def set(self, key, value):
+        """Saves a checkpoint. The file is written in full before it replaces any older one.
+
+        Args:
+            key (str): The checkpoint key.
+            value: The value to save. Must be JSON serializable.
+
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as checkpoint_file:
+            json.dump(value, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def delete(self, key):
+        """Removes a checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+
+        """
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class MemcachedCheckpoints(object):
+    """Stores checkpoints in memcached.
+
+    Memcached may evict checkpoints under memory pressure, in which case the work is redone.
+
+    Args:
+        servers (list): The memcached servers. Eg. ['127.0.0.1:11211'].
+        expires (int): Seconds to keep each checkpoint for. 0 keeps them until evicted. Default: 0.
+
+    """
+
+    def __init__(self, servers=('127.0.0.1:11211',), expires=0, **kwargs):
+        import pylibmc
+
+        self.client = pylibmc.Client(list(servers), binary=True)
+        self.expires = expires
+
+    def get(self, key):
+        """Loads a checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+
+        Returns:
+            tuple: Whether the checkpoint was found, and its value.
+
+        """
+        value = self.client.get('clearmetal/checkpoint/' + key)
+        if value is None:
+            return False, None
+        return True, json.loads(value)
+
+    def set(self, key, value):
+        """Saves a checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+            value: The value to save. Must be JSON serializable.
+
+        """
+        self.client.set('clearmetal/checkpoint/' + key, json.dumps(value), time=self.expires)
+
+    def delete(self, key):
+        """Removes a checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+
+        """
+        self.client.delete('clearmetal/checkpoint/' + key)
+
+
+backends = {
+    'disk': DiskCheckpoints,
+    'memcached': MemcachedCheckpoints
+}
+
+# The store built by 'get_store', by process and config.
+stores = {}
+
+
+def get_store():
+    """Gets the checkpoint store set in the config.
+
+    The store is built once per process and config, rather than for every task. A forked process builds its own, so
+    no memcached connection is shared across a fork.
+
+    Returns:
+        DiskCheckpoints, MemcachedCheckpoints: The checkpoint store, or None if checkpointing is turned off.
+
+    """
+    backend = config.checkpoint.get('backend')
+    if backend is None:
+        return None
+
+    store_id = (os.getpid(), json.dumps(config.checkpoint, sort_keys=True))
+    if store_id not in stores:
+        stores.clear()
+        stores[store_id] = backends[backend](**config.checkpoint)
+
+    return stores[store_id]
+
+
+def phase_key(pipeline_id, phase_number):
+    """Builds the checkpoint key of a finished phase. The checkpoint holds the phase's 'results' and the
+    'input_fingerprint' of the data it was started with.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+
+    Returns:
+        str: The checkpoint key.
+
+    """
+    return u'{}/{}/phase'.format(pipeline_id, phase_number)
+
+
+def manifest_key(pipeline_id, phase_number):
+    """Builds the checkpoint key of the manifest of a phase's segments.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+
+    Returns:
+        str: The checkpoint key.
+
+    """
+    return u'{}/{}/manifest'.format(pipeline_id, phase_number)
+
+
+def segment_key(pipeline_id, phase_number, do_number):
+    """Builds the checkpoint key of a finished segment.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        do_number (int): The segment number.
+
+    Returns:
+        str: The checkpoint key.
+
+    """
+    return u'{}/{}/segments/{}'.format(pipeline_id, phase_number, do_number)
+
+
+def fingerprint(value):
+    """Fingerprints a JSON serialisable value.
+
+    Args:
+        value: The value.
+
+    Returns:
+        str: The fingerprint.
+
+    """
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_state(path):
+    """Describes the state of a file by its size and modification time, so a changed file fingerprints differently.
+
+    Args:
+        path (str): The path to the file.
+
+    Returns:
+        list: The size and modification time in nanoseconds.
+
+    """
+    file_stat = os.stat(path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+def input_fingerprint(task_data):
+    """Fingerprints the input of a phase, so a phase checkpoint from a run with different input isn't reused.
+
+    Args:
+        task_data: The data the phase was started with. A path to a file is fingerprinted by the file's size and
+            modification time, not its contents.
+
+    Returns:
+        str: The fingerprint.
+
+    """
+    if isinstance(task_data, str) and os.path.isfile(task_data):
+        return fingerprint([task_data] + file_state(task_data))
+    return fingerprint(task_data)
+
+
+def segments_fingerprint(concurrent_tasks):
+    """Fingerprints the segments of a phase, so checkpoints from a run with different segments aren't reused.
+
+    The fingerprint covers the number of segments and each segment's data. A byte range of a file is fingerprinted by
+    the file's size and modification time, not its contents.
+
+    Args:
+        concurrent_tasks (list): The segment signatures returned by the phase 'prep'.
+
+    Returns:
+        str: The fingerprint.
+
+    """
+    segments = []
+    for segment in concurrent_tasks:
+        data = segment['args'][0] if len(segment['args']) > 0 else None
+        if isinstance(data, dict) and 'file' in data:
+            data = dict(data, file_state=file_state(data['file']))
+        segments.append([data, segment['args'][1:], segment['kwargs']])
+
+    return fingerprint(segments)
+
+
+def check_segments(store, pipeline_id, phase_number, concurrent_tasks):
+    """Discards the segment checkpoints of a phase if they came from a run with different segments.
+
+    The phase's manifest records the fingerprint and number of the segments that its checkpoints belong to. If the
+    pipeline is resumed with a different number of segments or different data, the old checkpoints are deleted and
+    the manifest is replaced.
+
+    Args:
+        store (DiskCheckpoints, MemcachedCheckpoints): The checkpoint store.
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        concurrent_tasks (list): The segment signatures returned by the phase 'prep'.
+
+    Returns:
+        bool: True if old checkpoints were discarded.
+
+    """
+    manifest = {'fingerprint': segments_fingerprint(concurrent_tasks), 'segments': len(concurrent_tasks)}
+
+    found, old_manifest = store.get(manifest_key(pipeline_id, phase_number))
+    if found and old_manifest == manifest:
+        return False
+
+    if found:
+        for do_number in range(old_manifest['segments']):
+            store.delete(segment_key(pipeline_id, phase_number, do_number))
+    store.set(manifest_key(pipeline_id, phase_number), manifest)
+
+    return found
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""Asyncio client for submitting pipelines and awaiting their results.
+
+Submit a pipeline and await its final result from a coroutine:
+
+    handle = await clearmetal.client.submit(
+        'moby_dick.txt', {'current_task': 'cm_word_count', 'all_tasks': ['cm_word_count', 'cm_add']}
+    )
+    final_result = await handle.result()
+
+or follow it phase by phase:
+
+    async for phase, phase_result in handle.progress():
+        print(phase, phase_result)
+
+Handles poll the result backend with 'asyncio.sleep' between checks, so many pipelines can be awaited from one event
+loop without a thread per job. The calls to the broker and the result backend are blocking, so they are made in the
+event loop's default executor, a thread pool shared by every job, rather than on the event loop thread.
+
+For tests, point the app at the in-memory transport and cache, and run a worker in the same process so they share the
+cache (see tests/test_client.py):
+
+    clearmetal.app.app.conf.update(broker_url='memory://', result_backend='cache+memory://')
+    with celery.contrib.testing.worker.start_worker(clearmetal.app.app, perform_ping_check=False):
+        ...
+
+"""
+
+import asyncio
+import functools
+import uuid
+
+import celery.result
+
+import clearmetal.app
+import clearmetal.tasks.main
+
+
+class PipelineError(Exception):
+    """Raised when a phase of a pipeline fails."""
+    pass
+
+
+class PipelineHandle(object):
+    """A handle on a whole multi-phase pipeline.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phases (list): The names of the phases in the pipeline, in order.
+        first_phase (int): The index of the phase the pipeline was submitted at. Default: 0.
+        poll_interval (float): Seconds to wait between checks of the result backend. Default: 0.5.
+
+    """
+
+    def __init__(self, pipeline_id, phases, first_phase=0, poll_interval=0.5):
+        self.pipeline_id = pipeline_id
+        self.phases = phases
+        self.first_phase = first_phase
+        self.poll_interval = poll_interval
+
+    def __repr__(self):
+        return u'<PipelineHandle {} {}>'.format(self.pipeline_id, self.phases)
+
+    def __await__(self):
+        return self.result().__await__()
+
+    def async_result(self, phase_number, stage='end'):
+        """Gets the Celery result of the start or end task of a phase.
+
+        Args:
+            phase_number (int): The index of the phase in the pipeline.
+            stage (str): Either 'start' or 'end'. Default: 'end'.
+
+        Returns:
+            celery.result.AsyncResult: The result.
+
+        """
+        return celery.result.AsyncResult(
+            clearmetal.tasks.main.phase_task_id(self.pipeline_id, phase_number, stage),
+            app=clearmetal.app.app
+        )
+
+    def forget(self):
+        """Clears the results of an earlier run of the pipeline, so the handle doesn't see them as this run's results.
+
+        The phase task ids only depend on the pipeline id, so resubmitting a pipeline under the same id would otherwise
+        find the old results straight away. This blocks, so it is run in an executor.
+
+        """
+        for phase_number in range(self.first_phase, len(self.phases)):
+            self.async_result(phase_number, 'start').forget()
+            self.async_result(phase_number, 'end').forget()
+
+    def phase_state(self, phase_number):
+        """Looks up the state of a phase in the result backend. This blocks, so it is run in an executor.
+
+        Args:
+            phase_number (int): The index of the phase in the pipeline.
+
+        Returns:
+            tuple: Whether the phase failed to start and why, and whether it has finished, failed and its results.
+
+        """
+        start_result = self.async_result(phase_number, 'start')
+        end_result = self.async_result(phase_number, 'end')
+
+        start_failed = start_result.failed()
+        end_ready = end_result.ready()
+
+        return (
+            start_failed,
+            start_result.result if start_failed else None,
+            end_ready,
+            end_ready and end_result.failed(),
+            end_result.result if end_ready else None
+        )
+
+    async def phase_result(self, phase_number, timeout=None):
+        """Waits for a phase to finish.
+
+        Args:
+            phase_number (int): The index of the phase in the pipeline.
+            timeout (float): Seconds to wait before giving up. Default: None, wait forever.
+
+        Returns:
+            The results of the phase.
+
+        Raises:
+            PipelineError: If the phase failed.
+            asyncio.TimeoutError: If the phase didn't finish in time.
+
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            start_failed, start_error, end_ready, end_failed, end_result = await loop.run_in_executor(
+                None, self.phase_state, phase_number
+            )
+            if end_ready:
+                break
+            if start_failed:
+                raise PipelineError(
+                    u'Phase {} ({}) of pipeline {} failed to start: {!r}'.format(
+                        phase_number, self.phases[phase_number], self.pipeline_id, start_error
+                    )
+                )
+            if deadline is not None and loop.time() >= deadline:
+                raise asyncio.TimeoutError(
+                    u'Phase {} ({}) of pipeline {} did not finish in {} seconds.'.format(
+                        phase_number, self.phases[phase_number], self.pipeline_id, timeout
+                    )
+                )
+            await asyncio.sleep(self.poll_interval)
+
+        if end_failed:
+            raise PipelineError(
+                u'Phase {} ({}) of pipeline {} failed: {!r}'.format(
+                    phase_number, self.phases[phase_number], self.pipeline_id, end_result
+                )
+            )
+
+        return end_result
+
+    async def progress(self, timeout=None):
+        """Iterates over the phases of the pipeline as they finish.
+
+        Args:
+            timeout (float): Seconds to wait for each phase before giving up. Default: None, wait forever.
+
+        Yields:
+            tuple: The name of the phase and its results.
+
+        """
+        for phase_number in range(self.first_phase, len(self.phases)):
+            phase = self.phases[phase_number]
+            phase_result = await self.phase_result(phase_number, timeout=timeout)
+            yield phase, phase_result
+
+    async def result(self, timeout=None):
+        """Waits for the final phase of the pipeline to finish.
+
+        Args:
+            timeout (float): Seconds to wait for each phase before giving up. Default: None, wait forever.
+
+        Returns:
+            The results of the final phase.
+
+        """
+        final_result = None
+        async for _, final_result in self.progress(timeout=timeout):
+            pass
+
+        return final_result
+
+
+async def submit(task_data, task_metadata, segments=8, pipeline_id=None, poll_interval=0.5):
+    """Submits a pipeline to the 'start_task' task. The message is published from the event loop's default executor.
+
+    Args:
+        task_data: The data to be processed by the first phase.
+        task_metadata: Metadata to control task chaining. Eg. {'current_task': 'cm_add'}.
+        segments (int): The number of segments to break each phase into. Default: 8.
+        pipeline_id (str): The id to give the pipeline. Default: None, a new id is generated.
+        poll_interval (float): Seconds the handle waits between checks of the result backend. Default: 0.5.
+
+    Returns:
+        PipelineHandle: A handle on the whole pipeline. Results left by an earlier run under the same 'pipeline_id' are
+            cleared first.
+
+    """
+    task_metadata = dict(task_metadata)
+    if pipeline_id is None:
+        pipeline_id = task_metadata.get('pipeline_id') or uuid.uuid4().hex
+    task_metadata['pipeline_id'] = pipeline_id
+
+    phases = task_metadata.get('all_tasks') or [task_metadata['current_task']]
+    first_phase = clearmetal.tasks.main.phase_index(task_metadata)
+
+    handle = PipelineHandle(pipeline_id, phases, first_phase=first_phase, poll_interval=poll_interval)
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, handle.forget)
+    await loop.run_in_executor(None, functools.partial(
+        clearmetal.tasks.main.start_task.apply_async,
+        args=[task_data, task_metadata],
+        kwargs={'segments': segments},
+        task_id=clearmetal.tasks.main.phase_task_id(pipeline_id, first_phase, 'start'),
+        priority=clearmetal.tasks.main.priority_value(task_metadata)
+    ))
+
+    return handle
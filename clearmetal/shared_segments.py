@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Moves segment data through shared memory instead of the broker when every worker is on the same host.
+
+The data for each segment is written to its own shared memory block, and only a small reference to the block travels
+through RabbitMQ. The blocks are released once every segment of the phase is done, or by the phase's error callback if
+one of its tasks fails.
+
+"""
+
+import json
+import multiprocessing.resource_tracker as resource_tracker
+import multiprocessing.shared_memory as shared_memory
+import socket
+import time
+
+import config
+import clearmetal.app
+
+# When co-location was last checked, and the answer.
+colocation_cache = {'checked_at': None, 'colocated': False}
+
+
+def workers_colocated(queue_name='app'):
+    """Checks whether every worker consuming from a queue is on this host.
+
+    Workers must be started with their host in their node name (eg. '-n app@%h') for this to work. A negative answer is
+    cached for 'cache_seconds' so the workers aren't asked for every phase. A positive answer is only cached for
+    'inspect_timeout' seconds, because a remote worker that joins in the meantime would be sent blocks it can't open.
+
+    Args:
+        queue_name (str): The name of the queue.
+
+    Returns:
+        bool: True if there is at least one worker and they are all on this host.
+
+    """
+    now = time.time()
+    checked_at = colocation_cache['checked_at']
+    if colocation_cache['colocated']:
+        cache_seconds = min(config.shared_memory['cache_seconds'], config.shared_memory['inspect_timeout'])
+    else:
+        cache_seconds = config.shared_memory['cache_seconds']
+    if checked_at is not None and now - checked_at < cache_seconds:
+        return colocation_cache['colocated']
+
+    active_queues = clearmetal.app.app.control.inspect(
+        timeout=config.shared_memory['inspect_timeout']
+    ).active_queues() or {}
+    hosts = set(
+        node_name.split('@', 1)[-1] for node_name, queues in active_queues.items()
+        if any(queue['name'] == queue_name for queue in queues)
+    )
+
+    colocation_cache['checked_at'] = now
+    colocation_cache['colocated'] = len(hosts) > 0 and hosts == {socket.gethostname()}
+
+    return colocation_cache['colocated']
+
+
+def use_shared_memory():
+    """Decides whether segment data should go through shared memory.
+
+    Returns:
+        bool: True to use shared memory.
+
+    """
+    enabled = config.shared_memory['enabled']
+    if enabled is False:
+        return False
+    if enabled == 'auto':
+        return workers_colocated()
+    return True
+
+
+def open_block(name=None, create=False, size=0):
+    """Opens a shared memory block without handing its clean up to the resource tracker.
+
+    The blocks outlive the process that creates them, so only 'release_blocks' should unlink them.
+
+    Args:
+        name (str): The name of the block. Default: None, a new name is generated.
+        create (bool): Whether to create a new block. Default: False.
+        size (int): The size of a new block in bytes.
+
+    Returns:
+        multiprocessing.shared_memory.SharedMemory: The block.
+
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # 'track' was added in python 3.13.
+        block = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+def share_segments(concurrent_tasks):
+    """Moves the data of each segment into its own shared memory block.
+
+    Args:
+        concurrent_tasks (list): The segment signatures returned by the phase 'prep'. The data is the first argument.
+
+    Returns:
+        tuple: The segment signatures with their data replaced by a block reference, and the names of the blocks.
+
+    """
+    block_names = []
+    for segment in concurrent_tasks:
+        data = json.dumps(segment['args'][0]).encode('utf-8')
+        block = open_block(create=True, size=max(len(data), 1))
+        block.buf[:len(data)] = data
+        block.close()
+
+        block_names.append(block.name)
+        segment['args'] = [{'shared_memory': block.name, 'size': len(data)}] + list(segment['args'][1:])
+
+    return concurrent_tasks, block_names
+
+
+def load_segment(segment):
+    """Replaces a block reference in a segment signature with the data in the block.
+
+    Args:
+        segment (celery.canvas.Signature): The segment signature.
+
+    Returns:
+        celery.canvas.Signature: The segment signature with its data. Signatures without a block reference are returned
+            as they are.
+
+    """
+    reference = segment['args'][0] if len(segment['args']) > 0 else None
+    if not isinstance(reference, dict) or 'shared_memory' not in reference:
+        return segment
+
+    try:
+        block = open_block(name=reference['shared_memory'])
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            u"Shared memory block {} isn't on {}. Was the worker started after the phase checked that every worker is "
+            u"on the same host?".format(reference['shared_memory'], socket.gethostname())
+        )
+    data = json.loads(bytes(block.buf[:reference['size']]).decode('utf-8'))
+    block.close()
+
+    segment['args'] = [data] + list(segment['args'][1:])
+
+    return segment
+
+
+def release_blocks(block_names):
+    """Unlinks shared memory blocks.
+
+    Args:
+        block_names (list): The names of the blocks.
+
+    """
+    for name in block_names:
+        try:
+            block = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""Mergeable single pass summaries of numbers.
+
+Each summary is built from one segment of the data and summaries from different segments can be merged in any order,
+so distribution statistics can be computed in one distributed pass without gathering the raw values in one process.
+The summaries are plain dicts and lists so they can be sent between tasks as JSON.
+
+"""
+
+import math
+import random
+
+
+def moments(values):
+    """Summarises the count, sum, min, max, mean and variance of some numbers in one pass (Welford's algorithm).
+
+    Args:
+        values (list): The numbers.
+
+    Returns:
+        dict: 'count', 'sum', 'min', 'max', 'mean' and 'm2' (the sum of squared differences from the mean).
+
+    """
+    summary = {'count': 0, 'sum': 0, 'min': None, 'max': None, 'mean': 0.0, 'm2': 0.0}
+    for value in values:
+        summary['count'] += 1
+        summary['sum'] += value
+        if summary['min'] is None or value < summary['min']:
+            summary['min'] = value
+        if summary['max'] is None or value > summary['max']:
+            summary['max'] = value
+        delta = value - summary['mean']
+        summary['mean'] += delta / summary['count']
+        summary['m2'] += delta * (value - summary['mean'])
+
+    return summary
+
+
+def merge_moments(a, b):
+    """Merges two moments summaries (Chan et al.'s parallel algorithm).
+
+    Args:
+        a (dict): A summary from 'moments'.
+        b (dict): A summary from 'moments'.
+
+    Returns:
+        dict: The summary of both sets of numbers.
+
+    """
+    if a['count'] == 0:
+        return dict(b)
+    if b['count'] == 0:
+        return dict(a)
+
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+
+    return {
+        'count': count,
+        'sum': a['sum'] + b['sum'],
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max']),
+        'mean': a['mean'] + delta * b['count'] / count,
+        'm2': a['m2'] + b['m2'] + delta * delta * a['count'] * b['count'] / count
+    }
+
+
+def histogram(values, low, high, bins):
+    """Counts some numbers into fixed width bins.
+
+    Args:
+        values (list): The numbers.
+        low (int, float): The lower edge of the first bin.
+        high (int, float): The upper edge of the last bin. Values equal to 'high' go in the last bin.
+        bins (int): The number of bins.
+
+    Returns:
+        dict: 'low', 'high', 'counts' (list) and the number of values outside the bins, 'underflow' and 'overflow'.
+
+    """
+    summary = {'low': low, 'high': high, 'counts': [0] * bins, 'underflow': 0, 'overflow': 0}
+    width = float(high - low) / bins
+    for value in values:
+        if value < low:
+            summary['underflow'] += 1
+        elif value > high:
+            summary['overflow'] += 1
+        elif width == 0:
+            summary['counts'][0] += 1
+        else:
+            summary['counts'][min(int((value - low) / width), bins - 1)] += 1
+
+    return summary
+
+
+def merge_histograms(a, b):
+    """Merges two histograms with the same bins.
+
+    Args:
+        a (dict): A summary from 'histogram'.
+        b (dict): A summary from 'histogram'.
+
+    Returns:
+        dict: The histogram of both sets of numbers.
+
+    """
+    assert (a['low'], a['high'], len(a['counts'])) == (b['low'], b['high'], len(b['counts']))
+
+    return {
+        'low': a['low'],
+        'high': a['high'],
+        'counts': [x + y for x, y in zip(a['counts'], b['counts'])],
+        'underflow': a['underflow'] + b['underflow'],
+        'overflow': a['overflow'] + b['overflow']
+    }
+
+
+def histogram_edges(summary):
+    """Finds the bin edges of a histogram.
+
+    Args:
+        summary (dict): A summary from 'histogram'.
+
+    Returns:
+        list: The edges of each bin, one more than the number of bins.
+
+    """
+    bins = len(summary['counts'])
+    width = float(summary['high'] - summary['low']) / bins
+
+    return [summary['low'] + width * i for i in range(bins)] + [summary['high']]
+
+
+def histogram_bins(summary):
+    """Lists the bins of a histogram with their counts.
+
+    Args:
+        summary (dict): A summary from 'histogram'.
+
+    Returns:
+        list: The lower edge, upper edge and count of each bin.
+
+    """
+    edges = histogram_edges(summary)
+
+    return [[edges[i], edges[i + 1], count] for i, count in enumerate(summary['counts'])]
+
+
+def log_bucket(value, base):
+    """Finds the log scale bucket of a positive number.
+
+    Args:
+        value (int, float): The number.
+        base (int, float): The ratio between the edges of consecutive buckets.
+
+    Returns:
+        int: The bucket 'i', covering [base**i, base**(i + 1)).
+
+    """
+    bucket = int(math.floor(math.log(value, base)))
+    # 'math.log' can be off by a little either side of an exact power of the base.
+    if base ** (bucket + 1) <= value:
+        bucket += 1
+    elif base ** bucket > value:
+        bucket -= 1
+
+    return bucket
+
+
+def log_histogram(values, base=2):
+    """Counts some numbers into log scale buckets, which need no range up front.
+
+    Positive numbers are counted into buckets [base**i, base**(i + 1)), negative numbers into the mirror images of
+    them, and zeros into a bucket of their own.
+
+    Args:
+        values (list): The numbers.
+        base (int, float): The ratio between the edges of consecutive buckets. Default: 2.
+
+    Returns:
+        dict: 'base', 'zero' (the number of zeros), and 'positive' and 'negative', the count in each non-empty bucket
+            keyed by its index as a string.
+
+    """
+    summary = {'base': base, 'zero': 0, 'positive': {}, 'negative': {}}
+    for value in values:
+        if value == 0:
+            summary['zero'] += 1
+            continue
+
+        side = summary['positive'] if value > 0 else summary['negative']
+        bucket = str(log_bucket(abs(value), base))
+        side[bucket] = side.get(bucket, 0) + 1
+
+    return summary
+
+
+def merge_log_histograms(a, b):
+    """Merges two log scale histograms with the same base.
+
+    Args:
+        a (dict): A summary from 'log_histogram'.
+        b (dict): A summary from 'log_histogram'.
+
+    Returns:
+        dict: The histogram of both sets of numbers.
+
+    """
+    assert a['base'] == b['base']
+
+    summary = {'base': a['base'], 'zero': a['zero'] + b['zero'], 'positive': dict(a['positive']),
+               'negative': dict(a['negative'])}
+    for side in ['positive', 'negative']:
+        for bucket, count in b[side].items():
+            summary[side][bucket] = summary[side].get(bucket, 0) + count
+
+    return summary
+
+
+def log_histogram_bins(summary):
+    """Lists the non-empty buckets of a log scale histogram with their counts, in order.
+
+    Args:
+        summary (dict): A summary from 'log_histogram'.
+
+    Returns:
+        list: The lower edge, upper edge and count of each bucket. Zeros are counted in the bucket [0, 0].
+
+    """
+    base = summary['base']
+    bins = [
+        [-base ** (int(bucket) + 1), -base ** int(bucket), summary['negative'][bucket]]
+        for bucket in sorted(summary['negative'], key=int, reverse=True)
+    ]
+    if summary['zero'] > 0:
+        bins.append([0, 0, summary['zero']])
+    bins.extend(
+        [base ** int(bucket), base ** (int(bucket) + 1), summary['positive'][bucket]]
+        for bucket in sorted(summary['positive'], key=int)
+    )
+
+    return bins
+
+
+def sketch_capacity(sketch, level):
+    """The number of items a level of a quantile sketch holds before it is compacted.
+
+    Args:
+        sketch (dict): A summary from 'quantile_sketch'.
+        level (int): The level.
+
+    Returns:
+        int: The capacity.
+
+    """
+    depth = len(sketch['compactors']) - level - 1
+    return int(math.ceil(sketch['k'] * (2.0 / 3.0) ** depth)) + 1
+
+
+def compress_sketch(sketch):
+    """Compacts the levels of a quantile sketch until it is within its size limit.
+
+    A full level is sorted and every other item, starting at random from the first or second, is promoted to the next
+    level up, where each item stands in for twice as many values. The random choices are seeded from the number of
+    values in the sketch, so the same data gives the same sketch every time.
+
+    Args:
+        sketch (dict): A summary from 'quantile_sketch'. Changed in place.
+
+    """
+    coin = random.Random(sketch['count'])
+    while sum(len(c) for c in sketch['compactors']) >= sum(
+            sketch_capacity(sketch, h) for h in range(len(sketch['compactors']))
+    ):
+        for level, compactor in enumerate(sketch['compactors']):
+            if len(compactor) >= sketch_capacity(sketch, level):
+                if level + 1 == len(sketch['compactors']):
+                    sketch['compactors'].append([])
+                compactor.sort()
+                # Keep the last item back if there is an odd number of them.
+                kept = [compactor.pop()] if len(compactor) % 2 == 1 else []
+                sketch['compactors'][level + 1].extend(compactor[coin.randint(0, 1)::2])
+                sketch['compactors'][level] = kept
+                break
+
+
+def quantile_sketch(values, k=200):
+    """Builds a KLL quantile sketch of some numbers.
+
+    The sketch keeps roughly 3k items however many numbers it summarises, and answers quantile queries with a rank
+    error of about 1/k.
+
+    Args:
+        values (list): The numbers.
+        k (int): The size of the sketch. Default: 200.
+
+    Returns:
+        dict: 'k', 'count', the number of values summarised, and 'compactors', a list of levels where each item at level
+            h stands in for 2**h values.
+
+    """
+    sketch = {'k': k, 'count': 0, 'compactors': [[]]}
+    for value in values:
+        sketch['count'] += 1
+        sketch['compactors'][0].append(value)
+        if len(sketch['compactors'][0]) >= sketch_capacity(sketch, 0):
+            compress_sketch(sketch)
+
+    return sketch
+
+
+def merge_quantile_sketches(a, b):
+    """Merges two quantile sketches.
+
+    Args:
+        a (dict): A summary from 'quantile_sketch'.
+        b (dict): A summary from 'quantile_sketch'.
+
+    Returns:
+        dict: The sketch of both sets of numbers.
+
+    """
+    levels = max(len(a['compactors']), len(b['compactors']))
+    sketch = {'k': max(a['k'], b['k']), 'count': a['count'] + b['count'], 'compactors': [[] for _ in range(levels)]}
+    for other in (a, b):
+        for level, compactor in enumerate(other['compactors']):
+            sketch['compactors'][level].extend(compactor)
+    compress_sketch(sketch)
+
+    return sketch
+
+
+def quantiles(sketch, levels):
+    """Estimates quantiles from a quantile sketch.
+
+    Args:
+        sketch (dict): A summary from 'quantile_sketch'.
+        levels (list): The quantiles to estimate, between 0 and 1. Eg. [0.25, 0.5, 0.75].
+
+    Returns:
+        list: The estimate of each quantile, or None for each if the sketch is empty.
+
+    """
+    weighted = sorted(
+        (value, 2 ** level) for level, compactor in enumerate(sketch['compactors']) for value in compactor
+    )
+    total = sum(weight for _, weight in weighted)
+    if total == 0:
+        return [None for _ in levels]
+
+    estimates = []
+    for q in levels:
+        rank = q * total
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= rank:
+                break
+        estimates.append(value)
+
+    return estimates
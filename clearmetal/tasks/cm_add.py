@@ -13,7 +13,8 @@ def prep(input, segments=8, **kwargs):
     """Prepares the adding job by segmenting the input list into sub lists and sending each sub list to the 'do' task.
 
     Args:
-        input (list): A list of numbers to add together. 
+        input (list, str): A list of numbers to add together, or the path to a tab separated counts file (such as the
+            one written by 'cm_word_count' when spilling to disk) whose last column holds the numbers.
         segments (int): The number of segments to break the job into. Default: 8.
         **kwargs: Key word args.
 
@@ -24,6 +25,19 @@ def prep(input, segments=8, **kwargs):
     
     l = kwargs.get('logger')
 
+    if isinstance(input, str):
+        l.info(
+            u'#{} Prep ADD. Target file: {}.'.format(u'-' * 8, input)
+        )
+
+        # Hand each 'do' task a line aligned byte range of the file, rather than reading the numbers into memory here.
+        sub_divided_data = clearmetal.utilities.subdivide_file(input, segments)
+        l.info(
+            u'#{} Segmenting the file into {} byte ranges.'.format(u'-' * 12, len(sub_divided_data))
+        )
+
+        return [do.s(sub_data, do_number=do_number) for do_number, sub_data in enumerate(sub_divided_data)]
+
     l.info(
         u'#{} Prep ADD. Total items: {}.'.format(u'-' * 8, len(input))
     )
@@ -64,7 +78,8 @@ def do(data, **kwargs):
     """Adds all the numbers in 'data' together and returns the results.
 
     Args: 
-        data (list): A list of numbers to add together. 
+        data (list, dict): A list of numbers to add together, or a byte range of a counts file from
+            'clearmetal.utilities.subdivide_file'.
         **kwargs: Key word args.
 
     Returns:
@@ -74,6 +89,7 @@ def do(data, **kwargs):
     """
     l = kwargs.get('logger')
     do_number = kwargs.get(u'do_number')
+    data = clearmetal.utilities.segment_numbers(data)
 
     l.info(
         u'#{} Do ADD. Segment {}, {} items.'
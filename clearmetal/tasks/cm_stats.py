@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Demo tasks to compute distribution statistics of numbers.
+
+Computes the count, sum, min, max, mean, variance, quantiles and a histogram in one distributed pass. Each 'do' task
+builds mergeable summaries of its segment and 'collect' merges them, so the raw values are never gathered in one place.
+
+"""
+
+import math
+
+import config
+import clearmetal.summaries
+import clearmetal.utilities
+import clearmetal.app
+
+
+@clearmetal.utilities.logger(logger_spec=config.logging['app'])
+def prep(input, segments=8, bin_range=None, **kwargs):
+    """Prepares the statistics job by segmenting the input list into sub lists and sending each sub list to the 'do' task.
+
+    Args:
+        input (list, str): A list of numbers, or the path to a tab separated counts file (such as the one written by
+            'cm_word_count' when spilling to disk) whose last column holds the numbers.
+        segments (int): The number of segments to break the job into. Default: 8.
+        bin_range (list): The lower and upper edges of a fixed width histogram. Default: None, 'bin_range' in the
+            'stats' config, or if that isn't set either, log scale buckets that need no range.
+        **kwargs: Key word args.
+
+    Returns:
+        list: List of distributed tasks.
+
+    """
+
+    l = kwargs.get('logger')
+
+    # The histogram range is never found from the data here, as that would take a serial pass over all of it.
+    if bin_range is None:
+        bin_range = config.stats.get('bin_range')
+
+    if isinstance(input, str):
+        l.info(
+            u'#{} Prep STATS. Target file: {}.'.format(u'-' * 8, input)
+        )
+
+        # Hand each 'do' task a line aligned byte range of the file, rather than reading the numbers into memory here.
+        sub_divided_data = clearmetal.utilities.subdivide_file(input, segments)
+        l.info(
+            u'#{} Segmenting the file into {} byte ranges.'.format(u'-' * 12, len(sub_divided_data))
+        )
+
+        return [
+            do.s(sub_data, do_number=do_number, bin_range=bin_range)
+            for do_number, sub_data in enumerate(sub_divided_data)
+        ]
+
+    l.info(
+        u'#{} Prep STATS. Total items: {}.'.format(u'-' * 8, len(input))
+    )
+
+    # Divide up the items to process them.
+    if len(input) > 0:
+        l.info(
+            u'#{} Segmenting {:,} items into {} segments.'.format(u'-' * 12, len(input), segments)
+        )
+        distributed_tasks = []
+        # Distribute the job
+        sub_divided_data = clearmetal.utilities.subdivide_list(input, segments)
+        for do_number, sub_data in enumerate(sub_divided_data):
+            distributed_tasks.append(
+                do.s(
+                    sub_data,
+                    do_number=do_number,
+                    bin_range=bin_range
+                )
+            )
+
+        return distributed_tasks
+    else:
+        l.info(
+            u'#{} No numbers to summarise.'.format(u'-' * 12)
+        )
+
+        return []
+
+
+@clearmetal.app.app.task(queue='app', default_retry_delay=60, max_retries=10)
+@clearmetal.utilities.logger(logger_spec=config.logging['app'])
+def do(data, **kwargs):
+    """Summarises the numbers in 'data'.
+
+    The histogram has fixed width bins over 'bin_range' if one is given, otherwise log scale buckets.
+
+    Args:
+        data (list, dict): A list of numbers to summarise, or a byte range of a counts file from
+            'clearmetal.utilities.subdivide_file'.
+        **kwargs: Key word args.
+
+    Returns:
+        dict: 'items_processed' (int): The number of numbers summarised.
+            'result' (dict): The 'moments', 'histogram' and 'quantiles' summaries of the numbers.
+
+    """
+    l = kwargs.get('logger')
+    do_number = kwargs.get(u'do_number')
+    bin_range = kwargs.get(u'bin_range')
+    data = clearmetal.utilities.segment_numbers(data)
+
+    l.info(
+        u'#{} Do STATS. Segment {}, {} items.'
+        .format(
+            u'-' * 8, do_number, len(data)
+        )
+    )
+
+    # Processing logic here
+    result = {
+        'moments': clearmetal.summaries.moments(data),
+        'histogram': clearmetal.summaries.log_histogram(data, base=config.stats['log_base']) if bin_range is None
+        else clearmetal.summaries.histogram(data, bin_range[0], bin_range[1], config.stats['bins']),
+        'quantiles': clearmetal.summaries.quantile_sketch(data, k=config.stats['sketch_size'])
+    }
+
+    return {'items_processed': len(data), 'result': result}
+
+
+@clearmetal.app.app.task(queue='app')
+@clearmetal.utilities.logger(logger_spec=config.logging['app'])
+def collect(results, **kwargs):
+    """Merges the summaries from the distributed tasks into the final statistics.
+
+    Args:
+        results (list): Results from the 'do' process.
+        **kwargs: Key word args.
+
+    Returns:
+        dict: 'count', 'sum', 'min', 'max', 'mean', 'variance' (population), 'sample_variance', 'stddev',
+            'quantiles' (dict of quantile to estimate) and 'histogram'. The histogram has 'bins', a list of the lower
+            edge, upper edge and count of each bin. Fixed width histograms also have the 'underflow' and 'overflow'
+            counts outside the range, and log scale ones their 'base'.
+
+    """
+    l = kwargs.get('logger')
+    l.info(
+        u'#{} Collect STATS.'.format(u'-' * 8)
+    )
+
+    l.info(
+        u'#{} {} results from {} total items.'.format(
+            u'-' * 12, len(results), sum([x['items_processed'] for x in results])
+        )
+    )
+
+    if len(results) == 0:
+        return {'count': 0}
+
+    moments = results[0]['result']['moments']
+    histogram = results[0]['result']['histogram']
+    sketch = results[0]['result']['quantiles']
+    for result in results[1:]:
+        moments = clearmetal.summaries.merge_moments(moments, result['result']['moments'])
+        if 'base' in histogram:
+            histogram = clearmetal.summaries.merge_log_histograms(histogram, result['result']['histogram'])
+        else:
+            histogram = clearmetal.summaries.merge_histograms(histogram, result['result']['histogram'])
+        sketch = clearmetal.summaries.merge_quantile_sketches(sketch, result['result']['quantiles'])
+
+    count = moments['count']
+    variance = moments['m2'] / count if count > 0 else None
+    final_result = {
+        'count': count,
+        'sum': moments['sum'],
+        'min': moments['min'],
+        'max': moments['max'],
+        'mean': moments['mean'] if count > 0 else None,
+        'variance': variance,
+        'sample_variance': moments['m2'] / (count - 1) if count > 1 else None,
+        'stddev': math.sqrt(variance) if variance is not None else None,
+        'quantiles': {
+            str(q): estimate for q, estimate in zip(
+                config.stats['quantiles'], clearmetal.summaries.quantiles(sketch, config.stats['quantiles'])
+            )
+        },
+        'histogram': histogram_result(histogram)
+    }
+
+    for key in ['count', 'sum', 'min', 'max', 'mean', 'variance', 'stddev']:
+        l.info(
+            u'#{} {}: {}.'.format(u'-' * 12, key, final_result[key])
+        )
+    for q in final_result['quantiles']:
+        l.info(
+            u'#{} Quantile {}: {}.'.format(u'-' * 12, q, final_result['quantiles'][q])
+        )
+    for low, high, bin_count in final_result['histogram']['bins']:
+        l.info(
+            u'#{} [{:g}, {:g}): {}.'.format(u'-' * 16, low, high, bin_count)
+        )
+
+    return final_result
+
+
+def histogram_result(histogram):
+    """Turns a merged histogram summary into the histogram reported by 'collect'.
+
+    Args:
+        histogram (dict): A summary from 'clearmetal.summaries.histogram' or 'clearmetal.summaries.log_histogram'.
+
+    Returns:
+        dict: The histogram's 'bins', with 'base' for log scale histograms, or 'underflow' and 'overflow' otherwise.
+
+    """
+    if 'base' in histogram:
+        return {'base': histogram['base'], 'bins': clearmetal.summaries.log_histogram_bins(histogram)}
+
+    return {
+        'bins': clearmetal.summaries.histogram_bins(histogram),
+        'underflow': histogram['underflow'],
+        'overflow': histogram['overflow']
+    }
@@ -2,7 +2,12 @@
 """Demo tasks to count words in a text file.
 
 """
+import heapq
+import itertools
+import os
+import shutil
 import string
+import uuid
 
 import stop_words
 
@@ -11,9 +16,68 @@ import clearmetal.utilities
 import clearmetal.app
 
 
+# Strips punctuation and turns all whitespace into spaces.
+strip_table = {
+    **str.maketrans({key: None for key in string.punctuation}),
+    **str.maketrans({key: ' ' for key in string.whitespace if key != ' '})
+}
+stop_word_set = set(stop_words.get_stop_words('en'))
+whitespace_bytes = [key.encode('ascii') for key in string.whitespace]
+
+
+def clean_words(text):
+    """Splits text into its significant words.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The lowercased words, without punctuation or stop words (if and but etc).
+
+    """
+    return [x for x in text.lower().translate(strip_table).split(' ') if x != '' and x not in stop_word_set]
+
+
+def read_words(path, start=0, end=None, chunk_size=1048576):
+    """Streams the significant words from a byte range of a text file, a chunk at a time.
+
+    Args:
+        path (str): The path to the UTF-8 text file.
+        start (int): The byte offset to start reading at. It should follow whitespace. Default: 0.
+        end (int): The byte offset to stop reading at. It should follow whitespace. Default: None, the end of the file.
+        chunk_size (int): The number of bytes to read at a time. Default: 1MB.
+
+    Yields:
+        str: The words, cleaned by 'clean_words'.
+
+    """
+    with open(path, 'rb') as text_file:
+        text_file.seek(start)
+        remaining = None if end is None else end - start
+        partial_word = b''
+        while True:
+            chunk = text_file.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if len(chunk) == 0:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+
+            # Hold back any word cut off at the end of the chunk until the rest of it has been read.
+            text = partial_word + chunk
+            cut = max(text.rfind(key) for key in whitespace_bytes) + 1
+            partial_word = text[cut:]
+            for word in clean_words(text[:cut].decode('utf-8')):
+                yield word
+
+        for word in clean_words(partial_word.decode('utf-8')):
+            yield word
+
+
 @clearmetal.utilities.logger(logger_spec=config.logging['app'])
 def prep(input, segments=8, **kwargs):
-    """
+    """Prepares the word count by segmenting the text file into byte ranges and sending each range to the 'do' task.
+
+    The file is never read here, each 'do' task reads and cleans its own range.
 
     Args:
         input (str): The path to the file to count words from. 
@@ -30,30 +94,17 @@ def prep(input, segments=8, **kwargs):
     l.info(
         u'#{} Prep word count. Target file: {}.'.format(u'-' * 8, input)
     )
-    
-    # Read the file in and strip punctuation and newlines. Also remove stop words (if and but etc).
-    with open(input, 'r') as myfile:
-        text = myfile.read()
-    punctuation_table = str.maketrans({key: None for key in string.punctuation})
-    whitespace_table = str.maketrans({key: ' ' for key in string.whitespace if key != ' '})
-    strip_table = {**punctuation_table, **whitespace_table}
-    mod_text = text.lower().translate(strip_table)
-    sw = set(stop_words.get_stop_words('en'))
-    all_words = [x for x in mod_text.split(' ') if x != '' and x not in sw]
-    
-    # Just to do a quick verification.
-    l.info(
-        u'#{} Total words: {}.'.format(u'-' * 12, len(all_words))
-    )
 
-    # Divide up the items to process them.
-    if len(all_words) > 0:
+    # Divide up the file, on whitespace so no word is split between segments.
+    sub_divided_data = clearmetal.utilities.subdivide_file(input, segments, whitespace=True)
+    if len(sub_divided_data) > 0:
         l.info(
-            u'#{} Segmenting {:,} items into {} segments.'.format(u'-' * 12, len(all_words), segments)
+            u'#{} Segmenting {:,} bytes into {} segments.'.format(
+                u'-' * 12, os.path.getsize(input), len(sub_divided_data)
+            )
         )
         distributed_tasks = []
         # Distribute the job
-        sub_divided_data = clearmetal.utilities.subdivide_list(all_words, segments)
         for do_number, sub_data in enumerate(sub_divided_data):
             distributed_tasks.append(
                 do.s(
@@ -65,7 +116,7 @@ def prep(input, segments=8, **kwargs):
         return distributed_tasks
     else:
         l.info(
-            u'#{} No numbers to add.'.format(u'-' * 12)
+            u'#{} No words to count.'.format(u'-' * 12)
         )
 
         return []
@@ -77,32 +128,61 @@ def do(data, **kwargs):
     """Counts the words in the input data.
 
     Args: 
-        data (list): A list of words to count. 
+        data (list, dict): A list of words to count, or a byte range of the text file from
+            'clearmetal.utilities.subdivide_file'.
         **kwargs: Key word args.
 
     Returns:
         dict: 'items_processed' (int): The number of words counted.
             'result' (dict): Words and their counts.
+            'runs' (list): Paths to the sorted run files, in place of 'result' when spilling to disk.
 
     """
     l = kwargs.get('logger')
     do_number = kwargs.get(u'do_number')
 
-    l.info(
-        u'#{} Do count words. Segment {}, {} items.'
-            .format(
-            u'-' * 8, do_number, len(data)
+    if isinstance(data, dict) and 'file' in data:
+        l.info(
+            u'#{} Do count words. Segment {}, bytes {:,} to {:,}.'.format(
+                u'-' * 8, do_number, data['start'], data['end']
+            )
         )
-    )
+        words = read_words(data['file'], start=data['start'], end=data['end'])
+    else:
+        l.info(
+            u'#{} Do count words. Segment {}, {} items.'
+                .format(
+                u'-' * 8, do_number, len(data)
+            )
+        )
+        words = data
+
+    spill_directory = config.word_count.get('spill_directory')
+    memory_budget = config.word_count.get('memory_budget')
 
     result = {}
+    runs = []
+    items_processed = 0
     # Processing logic here
-    for word in data:
+    for word in words:
+        items_processed += 1
         if word not in result:
+            if spill_directory is not None and len(result) >= memory_budget:
+                runs.append(write_run(result, spill_directory))
+                result = {}
             result[word] = 0
         result[word] += 1
 
-    return {'items_processed': len(data), 'result': result}
+    if spill_directory is not None:
+        if len(result) > 0:
+            runs.append(write_run(result, spill_directory))
+        l.info(
+            u'#{} Segment {} spilled {} runs to {}.'.format(u'-' * 12, do_number, len(runs), spill_directory)
+        )
+
+        return {'items_processed': items_processed, 'runs': runs}
+
+    return {'items_processed': items_processed, 'result': result}
 
 
 @clearmetal.app.app.task(queue='app')
@@ -115,7 +195,7 @@ def collect(results, **kwargs):
         **kwargs: Key word args.
 
     Returns:
-        list: A list containing the word counts. 
+        list, str: A list containing the word counts, or the path to the counts file when spilling to disk.
 
     """
     l = kwargs.get('logger')
@@ -129,6 +209,11 @@ def collect(results, **kwargs):
         )
     )
     
+    top_k = config.word_count.get('top_k')
+
+    if any('runs' in result for result in results):
+        return collect_runs(results, top_k, **kwargs)
+
     final_result = {}
     for result in results:
         for word in result['result']:
@@ -138,9 +223,9 @@ def collect(results, **kwargs):
                 final_result[word] += result['result'][word]
 
     l.info(
-        u'#{} Top 100.'.format(u'-' * 12)
+        u'#{} Top {}.'.format(u'-' * 12, top_k)
     )
-    for word in sorted(final_result, key=lambda x: final_result[x], reverse=True)[0:100]:
+    for word in sorted(final_result, key=lambda x: final_result[x], reverse=True)[0:top_k]:
         l.info(
             u'#{} {}: {}.'.format(
                 u'-' * 16, word, final_result[word]
@@ -148,3 +233,189 @@ def collect(results, **kwargs):
         )
 
     return [final_result[key] for key in final_result]
+
+
+def write_run(counts, spill_directory):
+    """Writes a sorted run of word counts to disk.
+
+    Each line of the run file is a word and its count separated by a tab, ordered by word.
+
+    Args:
+        counts (dict): Words and their counts.
+        spill_directory (str): The directory to write the run file to.
+
+    Returns:
+        str: The path to the run file.
+
+    """
+    os.makedirs(spill_directory, exist_ok=True)
+    path = os.path.join(spill_directory, '{}.run'.format(uuid.uuid4().hex))
+    with open(path, 'w', encoding='utf-8') as run_file:
+        for word in sorted(counts):
+            run_file.write(u'{}\t{}\n'.format(word, counts[word]))
+
+    return path
+
+
+def merge_run_files(paths, spill_directory):
+    """Merges sorted run files into a single sorted run file and removes them.
+
+    Args:
+        paths (list): Paths to the sorted run files.
+        spill_directory (str): The directory to write the merged run file to.
+
+    Returns:
+        str: The path to the merged run file.
+
+    """
+    path = os.path.join(spill_directory, '{}.run'.format(uuid.uuid4().hex))
+    with open(path, 'w', encoding='utf-8') as run_file:
+        for word, count in merge_runs(paths):
+            run_file.write(u'{}\t{}\n'.format(word, count))
+
+    for merged_path in paths:
+        os.remove(merged_path)
+
+    return path
+
+
+def reduce_runs(paths, spill_directory, fan_in):
+    """Merges run files at most 'fan_in' at a time until no more than 'fan_in' are left.
+
+    This keeps the number of files open at once bounded, however many runs the 'do' tasks spilled.
+
+    Args:
+        paths (list): Paths to the sorted run files.
+        spill_directory (str): The directory to write the merged run files to.
+        fan_in (int): The most run files to merge at once. Must be at least 2.
+
+    Returns:
+        list: Paths to the remaining run files.
+
+    """
+    if not isinstance(fan_in, int) or fan_in < 2:
+        raise ValueError(u"'merge_fan_in' must be an integer of at least 2, not {!r}.".format(fan_in))
+
+    while len(paths) > fan_in:
+        paths = [
+            merge_run_files(paths[i:i + fan_in], spill_directory) if len(paths[i:i + fan_in]) > 1 else paths[i]
+            for i in range(0, len(paths), fan_in)
+        ]
+
+    return paths
+
+
+def read_run(path):
+    """Streams the word counts from a run file.
+
+    Args:
+        path (str): The path to the run file.
+
+    Yields:
+        tuple: The word and its count.
+
+    """
+    with open(path, 'r', encoding='utf-8') as run_file:
+        for line in run_file:
+            word, count = line.rstrip(u'\n').split(u'\t')
+            yield word, int(count)
+
+
+def merge_runs(paths):
+    """Does a k-way streaming merge over sorted run files, summing the counts of each word.
+
+    Only one line per run is held in memory at a time, regardless of the size of the vocabulary.
+
+    Args:
+        paths (list): Paths to the sorted run files.
+
+    Yields:
+        tuple: Each word, in order, and its total count.
+
+    """
+    merged = heapq.merge(*[read_run(path) for path in paths], key=lambda x: x[0])
+    for word, group in itertools.groupby(merged, key=lambda x: x[0]):
+        yield word, sum(count for _, count in group)
+
+
+def temporary_files(results):
+    """Lists the files in the results of 'collect' that can be removed once the job is done.
+
+    Args:
+        results (list, str): The results of 'collect'.
+
+    Returns:
+        list: The path to the counts file when spilling to disk, otherwise nothing.
+
+    """
+    if isinstance(results, str):
+        return [results]
+    return []
+
+
+@clearmetal.utilities.logger(logger_spec=config.logging['app'])
+def collect_runs(results, top_k, **kwargs):
+    """Merges the run files from the 'do' tasks into a single counts file and outputs the top words in one pass.
+
+    Args:
+        results (list): List of results from the 'do' tasks. Each has a list of 'runs'.
+        top_k (int): The number of words to report.
+        **kwargs: Key word args.
+
+    Returns:
+        str: The path to the counts file. Each line is a word and its count separated by a tab, ordered by word.
+
+    """
+    l = kwargs.get('logger')
+
+    spill_directory = config.word_count.get('spill_directory')
+    paths = [path for result in results for path in result.get('runs', [])]
+
+    l.info(
+        u'#{} Merging {} runs.'.format(u'-' * 12, len(paths))
+    )
+
+    # The intermediate merges go in their own directory, so they can all be removed if the merge fails.
+    merge_directory = os.path.join(spill_directory, 'merge-{}'.format(uuid.uuid4().hex))
+    os.makedirs(merge_directory)
+    counts_path = os.path.join(spill_directory, 'counts-{}.tsv'.format(uuid.uuid4().hex))
+    top_words = []
+    try:
+        merged_paths = reduce_runs(paths, merge_directory, config.word_count.get('merge_fan_in'))
+
+        with open(counts_path, 'w', encoding='utf-8') as counts_file:
+            for word, count in merge_runs(merged_paths):
+                counts_file.write(u'{}\t{}\n'.format(word, count))
+                if len(top_words) < top_k:
+                    heapq.heappush(top_words, (count, word))
+                elif count > top_words[0][0]:
+                    heapq.heapreplace(top_words, (count, word))
+    except Exception:
+        l.info(
+            u'#{} Merge failed, removing the runs.'.format(u'-' * 12)
+        )
+        for path in paths + [counts_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(merge_directory, ignore_errors=True)
+        raise
+
+    for path in merged_paths:
+        os.remove(path)
+    shutil.rmtree(merge_directory, ignore_errors=True)
+
+    l.info(
+        u'#{} Top {}.'.format(u'-' * 12, top_k)
+    )
+    for count, word in sorted(top_words, reverse=True):
+        l.info(
+            u'#{} {}: {}.'.format(
+                u'-' * 16, word, count
+            )
+        )
+
+    l.info(
+        u'#{} Counts written to {}.'.format(u'-' * 12, counts_path)
+    )
+
+    return counts_path
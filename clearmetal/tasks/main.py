@@ -4,15 +4,23 @@
 """
 
 import datetime
+import json
+import os
+import time
+import uuid
 
 import celery
+import kombu
 
 import config
 import clearmetal.app
+import clearmetal.checkpoints
+import clearmetal.shared_segments
 import clearmetal.utilities
 
 # Need to explicitly import all of the phase tasks
 import clearmetal.tasks.cm_add
+import clearmetal.tasks.cm_stats
 import clearmetal.tasks.cm_word_count
 
 
@@ -39,6 +47,360 @@ def title_string(base_string):
     return base_string + (u'-' * (185 - len(base_string))) + u'#'
 
 
+def phase_index(task_metadata):
+    """Finds the position of the current phase in the pipeline.
+
+    Args:
+        task_metadata: Metadata to control task chaining.
+
+    Returns:
+        int: The index of 'current_task' in 'all_tasks', or 0 for a single phase job.
+
+    """
+    all_tasks = task_metadata.get('all_tasks')
+    if all_tasks is None:
+        return 0
+    return all_tasks.index(task_metadata['current_task'])
+
+
+def phase_task_id(pipeline_id, phase_number, stage):
+    """Builds the task id of the start or end task of a pipeline phase.
+
+    The ids are deterministic so the results of every phase can be looked up in the result backend knowing only the
+    pipeline id. For example, the end of the second phase of pipeline 'abc' is 'abc.1.end'.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        stage (str): Either 'start' or 'end'.
+
+    Returns:
+        str: The task id.
+
+    """
+    return u'{}.{}.{}'.format(pipeline_id, phase_number, stage)
+
+
+def priority_value(task_metadata):
+    """Looks up the message priority of a pipeline from its priority class.
+
+    Args:
+        task_metadata: Metadata to control task chaining. The priority class is read from 'priority'.
+
+    Returns:
+        int: The message priority. Higher numbers are served first.
+
+    """
+    priority_class = task_metadata.get('priority', config.scheduler['default_priority'])
+    return config.scheduler['priorities'][priority_class]
+
+
+def queue_depth(queue_name):
+    """Counts the messages waiting on a queue.
+
+    Args:
+        queue_name (str): The name of the queue.
+
+    Returns:
+        int: The number of messages waiting, or None if the broker can't be asked.
+
+    """
+    try:
+        with clearmetal.app.app.connection_or_acquire() as connection:
+            return connection.default_channel.queue_declare(queue=queue_name, passive=True).message_count
+    except Exception:
+        return None
+
+
+class SchedulerError(Exception):
+    """Raised when a phase's scheduling state is missing from the result backend, eg. because memcached evicted it."""
+    pass
+
+
+def scheduler_key(pipeline_id, phase_number, name):
+    """Builds the result backend key of a piece of a phase's scheduling state.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        name (str): The name of the piece of state. Eg. 'done' or 'result.3'.
+
+    Returns:
+        str: The key.
+
+    """
+    return u'clearmetal-scheduler-{}-{}-{}'.format(pipeline_id, phase_number, name)
+
+
+def scheduler_value(pipeline_id, phase_number, name, increment=False):
+    """Reads, or increments and reads, a piece of a phase's scheduling state from the result backend.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        name (str): The name of the piece of state.
+        increment (bool): Increment the value by one first. Default: False.
+
+    Returns:
+        The value.
+
+    Raises:
+        SchedulerError: If the value isn't in the result backend.
+
+    """
+    backend = clearmetal.app.app.backend
+    key = scheduler_key(pipeline_id, phase_number, name)
+    message = (
+        u"The scheduler's '{}' for phase {} of pipeline {} could not be read from the result backend. It may have been "
+        u"evicted or been too large to store.".format(name, phase_number, pipeline_id)
+    )
+
+    # Depending on the backend, a missing key either raises or reads as None.
+    try:
+        value = backend.incr(key) if increment else backend.get(key)
+    except Exception as e:
+        raise SchedulerError(message) from e
+    if value is None:
+        raise SchedulerError(message)
+
+    return value
+
+
+def pending_queue(pipeline_id, phase_number):
+    """Gets the broker queue holding a phase's segments until they are released.
+
+    Nothing consumes from it. Segments are taken off it one at a time by 'release_segment'. It expires once it has gone
+    unused for 'pending_expires' seconds, so the queue of a phase that failed doesn't stay around.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+
+    Returns:
+        kombu.Queue: The queue, bound to the default exchange.
+
+    """
+    name = u'clearmetal-pending-{}-{}'.format(pipeline_id, phase_number)
+    return kombu.Queue(
+        name, exchange=kombu.Exchange(''), routing_key=name, durable=True,
+        queue_arguments={'x-expires': int(config.scheduler['pending_expires'] * 1000)}
+    )
+
+
+def schedule_segments(
+        concurrent_tasks, continuation, max_in_flight, priority, pipeline_id, phase_number, shared_blocks=None
+):
+    """Sends the segments of a phase to the 'app' queue, with at most 'max_in_flight' of them there at once.
+
+    The first 'max_in_flight' segments are sent to the 'app' queue straight away. The rest wait on the phase's pending
+    queue in the broker, and as each segment finishes it moves the next one across. Priority between pipelines
+    therefore takes effect between every segment, and a slow segment only holds up its own worker. Each segment
+    message carries its own data and the phase's continuation, and the last segment to finish starts the
+    continuation.
+
+    Only a counter of finished segments, their results and the names of any shared memory blocks are kept in the
+    result backend. The counter uses the backend's 'incr', so the backend must be a key value store such as memcached
+    or redis.
+
+    Args:
+        concurrent_tasks (list): The segment signatures returned by the phase 'prep'.
+        continuation (celery.canvas.Signature): What to run once every segment is done. It starts with
+            'gather_segments'.
+        max_in_flight (int): The maximum number of segments in flight at once.
+        priority (int): The message priority of the segments.
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        shared_blocks (list): Names of the shared memory blocks holding the segment data. Kept with the scheduling
+            state so 'fail_phase' can release them.
+
+    """
+    backend = clearmetal.app.app.backend
+
+    backend.set(scheduler_key(pipeline_id, phase_number, 'blocks'), json.dumps(shared_blocks or []))
+    backend.set(scheduler_key(pipeline_id, phase_number, 'done'), '0')
+
+    if len(concurrent_tasks) == 0:
+        continuation.apply_async()
+        return
+
+    segment_runs = [
+        run_segment.s(
+            segment, pipeline_id, phase_number, segment_number, len(concurrent_tasks), continuation
+        ).set(
+            priority=priority, link_error=[fail_phase.s(pipeline_id, phase_number)]
+        )
+        for segment_number, segment in enumerate(concurrent_tasks)
+    ]
+
+    queue = pending_queue(pipeline_id, phase_number)
+    with clearmetal.app.app.producer_or_acquire() as producer:
+        queue(producer.channel).declare()
+        for segment_run in segment_runs[max_in_flight:]:
+            producer.publish(
+                dict(segment_run), exchange='', routing_key=queue.routing_key, declare=[queue], serializer='json'
+            )
+
+    for segment_run in segment_runs[:max_in_flight]:
+        segment_run.apply_async(kwargs={'enqueued_at': time.time()})
+
+
+def release_segment(pipeline_id, phase_number):
+    """Takes the next segment off a phase's pending queue and sends it to the 'app' queue.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+
+    Returns:
+        bool: False if there were no segments left to send.
+
+    """
+    queue = pending_queue(pipeline_id, phase_number)
+    with clearmetal.app.app.connection_or_acquire() as connection:
+        message = queue(connection.default_channel).get(no_ack=False, accept=['json'])
+        if message is None:
+            return False
+
+        # Only acknowledged once it's on the 'app' queue, so the segment isn't lost if this worker dies in between.
+        celery.signature(message.payload, app=clearmetal.app.app).apply_async(kwargs={'enqueued_at': time.time()})
+        message.ack()
+
+    return True
+
+
+@clearmetal.app.app.task(queue='app')
+@clearmetal.utilities.logger(logger_spec=config.logging['app'])
+def run_segment(
+        segment, pipeline_id, phase_number, segment_number, total, continuation, enqueued_at=None, **kwargs
+):
+    """Runs one segment of a phase, then releases the next pending one.
+
+    A segment with a checkpoint from an earlier run of the pipeline is skipped, and a newly finished segment is
+    checkpointed. The last segment of the phase to finish starts the phase's continuation.
+
+    Args:
+        segment (celery.canvas.Signature): The segment's 'do' task, with its data.
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        segment_number (int): The index of the segment in the phase.
+        total (int): The number of segments in the phase.
+        continuation (celery.canvas.Signature): What to run once every segment is done.
+        enqueued_at (float): When the segment was put on the queue, in seconds since the epoch.
+        **kwargs: Key word args.
+
+    """
+    l = kwargs.get('logger')
+    backend = clearmetal.app.app.backend
+
+    if enqueued_at is not None:
+        l.info(
+            u'#{} Segment {} of {} waited {:.3f}s on the queue.'.format(
+                u'-' * 8, segment_number, total, time.time() - enqueued_at
+            )
+        )
+
+    segment = celery.signature(segment, app=clearmetal.app.app)
+
+    store = clearmetal.checkpoints.get_store()
+    if store is None:
+        result = clearmetal.shared_segments.load_segment(segment)()
+    else:
+        key = clearmetal.checkpoints.segment_key(pipeline_id, phase_number, segment.kwargs.get('do_number'))
+        found, result = store.get(key)
+        if found:
+            l.info(
+                u'#{} Segment {} already done, using its checkpoint.'.format(u'-' * 8, segment.kwargs.get('do_number'))
+            )
+        else:
+            result = clearmetal.shared_segments.load_segment(segment)()
+            store.set(key, result)
+
+    backend.set(scheduler_key(pipeline_id, phase_number, 'result.{}'.format(segment_number)), json.dumps(result))
+
+    release_segment(pipeline_id, phase_number)
+
+    if int(scheduler_value(pipeline_id, phase_number, 'done', increment=True)) == total:
+        celery.signature(continuation, app=clearmetal.app.app).apply_async()
+
+
+@clearmetal.app.app.task(queue='app')
+def fail_phase(request, exc, traceback, pipeline_id, phase_number):
+    """Error callback for the tasks of a phase. Records the failure as the failure of the phase's end task, stops any
+    pending segments from starting, and releases the phase's shared memory blocks if 'gather_segments' hasn't already.
+
+    Otherwise a failed segment or 'collect' would leave the end task pending forever, and anything waiting on the
+    phase would never find out.
+
+    Args:
+        request: The request of the failed task.
+        exc (Exception): The exception it raised.
+        traceback (str): Its traceback.
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+
+    """
+    backend = clearmetal.app.app.backend
+
+    shared_blocks = backend.get(scheduler_key(pipeline_id, phase_number, 'blocks'))
+    if shared_blocks is not None:
+        clearmetal.shared_segments.release_blocks(json.loads(shared_blocks))
+
+    backend.mark_as_failure(phase_task_id(pipeline_id, phase_number, 'end'), exc, traceback=traceback)
+
+    # The pending queue is gone if 'gather_segments' already ran, or if the phase had no segments.
+    try:
+        with clearmetal.app.app.connection_or_acquire() as connection:
+            pending_queue(pipeline_id, phase_number)(connection.default_channel).purge()
+    except Exception:
+        pass
+
+
+@clearmetal.app.app.task(queue='app')
+def gather_segments(pipeline_id, phase_number, total, shared_blocks=None):
+    """Gathers the results of every segment of a phase into a list for the phase 'collect', and clears up the
+    phase's scheduling state.
+
+    Args:
+        pipeline_id (str): The id of the pipeline.
+        phase_number (int): The index of the phase in the pipeline.
+        total (int): The number of segments in the phase.
+        shared_blocks (list): Names of the shared memory blocks holding the segment data, released now that every
+            segment is done.
+
+    Returns:
+        list: The segment results.
+
+    """
+    backend = clearmetal.app.app.backend
+
+    # Drop the segment checkpoints before 'collect' runs. It may delete files the segment results point to (such as
+    # the spilled word count runs), so a restarted phase must not reuse them. If the job dies from here on, the phase
+    # is redone in full.
+    store = clearmetal.checkpoints.get_store()
+    if store is not None:
+        for segment_number in range(total):
+            store.delete(clearmetal.checkpoints.segment_key(pipeline_id, phase_number, segment_number))
+        store.delete(clearmetal.checkpoints.manifest_key(pipeline_id, phase_number))
+
+    results = [
+        json.loads(scheduler_value(pipeline_id, phase_number, 'result.{}'.format(segment_number)))
+        for segment_number in range(total)
+    ]
+    for segment_number in range(total):
+        backend.delete(scheduler_key(pipeline_id, phase_number, 'result.{}'.format(segment_number)))
+    for name in ['blocks', 'done']:
+        backend.delete(scheduler_key(pipeline_id, phase_number, name))
+
+    if total > 0:
+        with clearmetal.app.app.connection_or_acquire() as connection:
+            pending_queue(pipeline_id, phase_number)(connection.default_channel).delete()
+
+    if shared_blocks:
+        clearmetal.shared_segments.release_blocks(shared_blocks)
+
+    return results
+
+
 @clearmetal.app.app.task(queue='app')
 @clearmetal.utilities.logger(logger_spec=config.logging['app'])
 def start_task(
@@ -48,19 +410,44 @@ def start_task(
 
     Args:
         task_data: The data to be processed by the task.
-        task_metadata: Metadata to control task chaining.
+        task_metadata: Metadata to control task chaining. A 'pipeline_id' is added if there isn't one already. The
+            optional 'priority' and 'max_in_flight' control how the segments are scheduled.
         segments (int): The number of segments to break the job into. Default: 8. 
         **kwargs: Key word args.
 
     """
     l = kwargs.get('logger')
     
+    if task_metadata.get('pipeline_id') is None:
+        task_metadata['pipeline_id'] = uuid.uuid4().hex
+
     l.info(title_string(
-        u'# Begin {} '.format(task_metadata['current_task'])
+        u'# Begin {} ({}) '.format(task_metadata['current_task'], task_metadata['pipeline_id'])
     ))
     
     del kwargs['logger']
 
+    pipeline_id = task_metadata['pipeline_id']
+    phase_number = phase_index(task_metadata)
+    priority = priority_value(task_metadata)
+
+    store = clearmetal.checkpoints.get_store()
+    if store is not None:
+        # Kept with the phase checkpoint, so a run with different input doesn't reuse it.
+        task_metadata['input_fingerprint'] = clearmetal.checkpoints.input_fingerprint(task_data)
+        found, phase_checkpoint = store.get(clearmetal.checkpoints.phase_key(pipeline_id, phase_number))
+        if found and phase_checkpoint['input_fingerprint'] == task_metadata['input_fingerprint']:
+            l.info(
+                u'#{} Phase already done, using its checkpoint.'.format(u'-' * 8)
+            )
+            end_task.apply_async(
+                args=[phase_checkpoint['results'], task_metadata],
+                kwargs=dict(segments=segments, **kwargs),
+                task_id=phase_task_id(pipeline_id, phase_number, 'end'),
+                priority=priority
+            )
+            return
+
     phase_tasks = 'clearmetal.tasks.{}'.format(task_metadata['current_task'].lower())
 
     concurrent_tasks = eval(phase_tasks).prep(
@@ -68,20 +455,47 @@ def start_task(
         segments=segments, **kwargs
     )
 
-    process = celery.chord(
-        concurrent_tasks,
-        eval(phase_tasks).collect.s()
+    if store is not None and clearmetal.checkpoints.check_segments(store, pipeline_id, phase_number, concurrent_tasks):
+        l.info(
+            u'#{} The segments have changed since the last run, discarding their checkpoints.'.format(u'-' * 8)
+        )
+
+    shared_blocks = []
+    if len(concurrent_tasks) > 0 and clearmetal.shared_segments.use_shared_memory():
+        concurrent_tasks, shared_blocks = clearmetal.shared_segments.share_segments(concurrent_tasks)
+        l.info(
+            u'#{} Workers are on this host. Sharing segment data through {} shared memory blocks.'.format(
+                u'-' * 8, len(shared_blocks)
+            )
+        )
+
+    max_in_flight = task_metadata.get('max_in_flight', config.scheduler['max_in_flight'])
+
+    l.info(
+        u'#{} Scheduling {} segments, at most {} in flight, priority {}. Queue depth: {}.'.format(
+            u'-' * 8, len(concurrent_tasks), max_in_flight, priority, queue_depth('app')
+        )
     )
-    celery.chain(
+
+    continuation = celery.chain(
         [
-            process,
+            gather_segments.s(
+                pipeline_id, phase_number, len(concurrent_tasks), shared_blocks=shared_blocks
+            ).set(priority=priority, link_error=[fail_phase.s(pipeline_id, phase_number)]),
+            eval(phase_tasks).collect.s().set(priority=priority, link_error=[fail_phase.s(pipeline_id, phase_number)]),
             end_task.s(
                 task_metadata,
                 segments=segments,
                 **kwargs
+            ).set(
+                task_id=phase_task_id(pipeline_id, phase_number, 'end'),
+                priority=priority
             )
         ]
-    ).delay()
+    )
+    schedule_segments(
+        concurrent_tasks, continuation, max_in_flight, priority, pipeline_id, phase_number, shared_blocks=shared_blocks
+    )
 
 
 @clearmetal.app.app.task(queue='app')
@@ -95,6 +509,9 @@ def end_task(task_results, task_metadata, segments=8, **kwargs):
         segments (int): The number of segments to break the job into. Default: 8. 
         **kwargs: Key word args.
 
+    Returns:
+        The results from the current task, so they can be retrieved from the result backend.
+
     """
     l = kwargs.get('logger')
     
@@ -103,8 +520,38 @@ def end_task(task_results, task_metadata, segments=8, **kwargs):
     ))
 
     del kwargs['logger']
-    
+
     all_tasks = task_metadata.get('all_tasks')
+    phase_number = phase_index(task_metadata)
+    job_done = all_tasks is None or phase_number + 1 == len(all_tasks)
+
+    # Checkpoint the phase so a restarted job can skip it. Once the whole job is done none of its checkpoints are
+    # needed any more.
+    store = clearmetal.checkpoints.get_store()
+    if store is not None:
+        if job_done:
+            for finished_phase in range(phase_number):
+                store.delete(clearmetal.checkpoints.phase_key(task_metadata['pipeline_id'], finished_phase))
+        else:
+            store.set(
+                clearmetal.checkpoints.phase_key(task_metadata['pipeline_id'], phase_number),
+                {'input_fingerprint': task_metadata.get('input_fingerprint'), 'results': task_results}
+            )
+
+    # Files that only carry results from one phase to the next, such as the spilled word counts, are removed once the
+    # job is done. The final phase's results are the job's output, so they are kept.
+    if job_done:
+        for path in task_metadata.get('temporary_files', []):
+            if os.path.exists(path):
+                os.remove(path)
+                l.info(u'#{} Removed {}.'.format(u'-' * 8, path))
+    else:
+        phase_tasks = eval('clearmetal.tasks.{}'.format(task_metadata['current_task'].lower()))
+        if hasattr(phase_tasks, 'temporary_files'):
+            task_metadata['temporary_files'] = (
+                task_metadata.get('temporary_files', []) + phase_tasks.temporary_files(task_results)
+            )
+
     if all_tasks is not None:
         current_task_id = all_tasks.index(task_metadata['current_task'])
         new_phase_id = current_task_id + 1
@@ -117,6 +564,11 @@ def end_task(task_results, task_metadata, segments=8, **kwargs):
             # Prep the new phase
             task_metadata['current_task'] = all_tasks[new_phase_id]
     
-            start_task.delay(
-                task_results, task_metadata, segments=segments, **kwargs
+            start_task.apply_async(
+                args=[task_results, task_metadata],
+                kwargs=dict(segments=segments, **kwargs),
+                task_id=phase_task_id(task_metadata['pipeline_id'], new_phase_id, 'start'),
+                priority=priority_value(task_metadata)
             )
+
+    return task_results
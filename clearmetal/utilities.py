@@ -14,15 +14,197 @@ import time
 import math
 import importlib
 import json
+import re
+import atexit
+import multiprocessing
+import multiprocessing.queues
+import multiprocessing.reduction
+import threading
 
 default_logger_spec = {
     'datefmt': '%Y-%m-%d %H:%M:%S %z',
     'file': 'logs/log.log',
     'format': '[%(asctime)s +0000: %(levelname)s/%(name)s] %(message)s',
     'level': 20,
-    'handler_type': 'file'
+    'handler_type': 'file',
+    'batch_size': 100,
+    'put_timeout': 1.0
 }
 
+# Log aggregators by file.
+log_aggregators = {}
+
+
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """A rotating file handler that only flushes when told to, so a whole batch of records is written at once."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class LogQueue(multiprocessing.queues.SimpleQueue):
+    """A 'multiprocessing.SimpleQueue' whose 'put' gives up if it can't get the write lock in time.
+
+    The write lock is shared by every process on the queue. If a process is killed while holding it, or the aggregator
+    falls behind and the pipe fills up, an untimed 'put' would block every process that logs.
+
+    """
+
+    def __init__(self):
+        super().__init__(ctx=multiprocessing.get_context())
+
+    def put(self, obj, timeout=None):
+        """Puts an object on the queue.
+
+        Args:
+            obj: The object.
+            timeout (float): Seconds to wait for the write lock. Default: None, wait forever.
+
+        Returns:
+            bool: False if the lock couldn't be got in time and the object wasn't put on the queue.
+
+        """
+        obj = multiprocessing.reduction.ForkingPickler.dumps(obj)
+        if self._wlock is None:
+            self._writer.send_bytes(obj)
+            return True
+
+        if not self._wlock.acquire(timeout=timeout):
+            return False
+        try:
+            self._writer.send_bytes(obj)
+        finally:
+            self._wlock.release()
+        return True
+
+
+class LogAggregator(object):
+    """Writes the log records from every process on the host to a single file, in batches, from one thread.
+
+    Processes put records on a shared queue with an 'AggregatorHandler' and return straight away. The aggregator
+    thread takes whatever records are waiting, up to 'batch_size' at a time, writes them and flushes once. Since only
+    one thread ever writes to or rotates the file, lines are not lost or interleaved during rotation.
+
+    The aggregator must be started before the worker pool forks so the pool processes inherit its queue. The queue is
+    a 'LogQueue', which writes straight to its pipe. A 'multiprocessing.Queue' would hand records to a feeder thread,
+    and if the parent had logged before forking, the child would inherit a feeder that no longer runs and its records
+    would be dropped.
+
+    A process that can't get the queue's write lock within 'put_timeout' seconds writes the record to the file itself
+    (see 'AggregatorHandler'), so a stuck process doesn't hang every other one. A process killed partway through
+    writing a record still corrupts the queue, and the aggregator stops.
+
+    Args:
+        file (str): The file to write to. It is rotated at 2MB.
+        format (str): The log format.
+        datefmt (str): The date format.
+        batch_size (int): The most records to write before flushing. Default: 100.
+        put_timeout (float): Seconds a process waits to put a record on the queue. Default: 1.
+
+    """
+
+    def __init__(self, file, format, datefmt=None, batch_size=100, put_timeout=1.0):
+        self.file = file
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.pid = os.getpid()
+        self.queue = LogQueue()
+        if os.path.dirname(file) != '':
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.handler = BatchedRotatingFileHandler(file, backupCount=100, maxBytes=2000000)
+        formatter = logging.Formatter(format, datefmt=datefmt)
+        formatter.converter = time.gmtime
+        self.handler.setFormatter(formatter)
+        self.thread = threading.Thread(target=self.monitor, name='LogAggregator', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def monitor(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get())
+
+            for record in batch:
+                if record is None:
+                    running = False
+                else:
+                    self.handler.handle(record)
+            self.handler.flush_batch()
+
+    def stop(self):
+        """Writes any waiting records and stops the aggregator thread.
+
+        Only the process that started the aggregator can stop it. Forked children just stop using it.
+
+        """
+        if log_aggregators.get(self.file) is self:
+            del log_aggregators[self.file]
+        if os.getpid() != self.pid:
+            return
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.handler.close()
+
+
+class AggregatorHandler(logging.handlers.QueueHandler):
+    """Sends records to the log aggregator for a file, if this process or its parent started one.
+
+    Otherwise, such as in the client or a standalone beat, or if the aggregator's queue is stuck, the records are
+    written to the file directly.
+
+    Args:
+        file (str): The file the aggregator writes to.
+        fallback (logging.Handler): The handler to use when there is no aggregator.
+
+    """
+
+    def __init__(self, file, fallback):
+        super().__init__(None)
+        self.file = file
+        self.fallback = fallback
+
+    def emit(self, record):
+        aggregator = log_aggregators.get(self.file)
+        if aggregator is None:
+            self.fallback.handle(record)
+            return
+
+        try:
+            if not aggregator.queue.put(self.prepare(record), timeout=aggregator.put_timeout):
+                self.fallback.handle(record)
+        except Exception:
+            self.handleError(record)
+
+
+def get_log_aggregator(**logger_spec):
+    """Gets the log aggregator for a file, starting it if this is the first time it is asked for.
+
+    Args:
+        **logger_spec: Keyword arguments specifying the logger config.
+
+    Returns:
+        LogAggregator: The log aggregator.
+
+    """
+    file = logger_spec.get('file')
+    if file not in log_aggregators:
+        log_aggregators[file] = LogAggregator(
+            file,
+            logger_spec.get('format', default_logger_spec['format']),
+            datefmt=logger_spec.get('date_format'),
+            batch_size=logger_spec.get('batch_size', default_logger_spec['batch_size']),
+            put_timeout=logger_spec.get('put_timeout', default_logger_spec['put_timeout'])
+        )
+
+    return log_aggregators[file]
+
 
 def set_up_logger(in_logger, **logger_spec):
     """Sets up a logging instance.
@@ -50,7 +232,7 @@ def set_up_logger(in_logger, **logger_spec):
     if len(in_logger.handlers) > 0:
         in_logger.handlers = []
 
-    if handler_type in ['auto_rotate', 'file']:
+    if handler_type in ['auto_rotate', 'file', 'queue']:
         if file is None:
             file = 'log.log'
         else:
@@ -71,12 +253,20 @@ def set_up_logger(in_logger, **logger_spec):
         )
     elif handler_type == 'file':
         handler = logging.handlers.RotatingFileHandler(file, backupCount=100)
+    elif handler_type == 'queue':
+        handler = AggregatorHandler(
+            file, logging.handlers.RotatingFileHandler(file, backupCount=100, maxBytes=2000000, delay=True)
+        )
     else:
         handler = logging.StreamHandler()
 
     formatter = logging.Formatter(format, datefmt=date_format)
     formatter.converter = time.gmtime
-    handler.setFormatter(formatter)
+    if handler_type == 'queue':
+        # The aggregator formats the records itself.
+        handler.fallback.setFormatter(formatter)
+    else:
+        handler.setFormatter(formatter)
     in_logger.addHandler(handler)
     in_logger.setLevel(level)
 
@@ -95,25 +285,29 @@ def logger(**logger_kwargs):
     """
 
     def decorator(func):
+        # The logger is set up on the first call and reused after that, rather than building new handlers every call.
+        configured = {}
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # Make sure we have a complete logger spec
-            logger_spec = logger_kwargs.get('logger_spec')
-            if logger_spec is None:
-                logger_spec = default_logger_spec
-            else:
-                logger_spec = logger_spec
-                for key in default_logger_spec:
-                    if key not in logger_spec:
-                        logger_spec[key] = default_logger_spec[key]
-
-            # Set up the logger
-            l = set_up_logger(
-                logging.getLogger('{}.{}'.format(func.__module__, func.__name__)),
-                **logger_spec
-            )
-
-            kwargs['logger'] = l
+            if 'logger' not in configured:
+                # Make sure we have a complete logger spec
+                logger_spec = logger_kwargs.get('logger_spec')
+                if logger_spec is None:
+                    logger_spec = default_logger_spec
+                else:
+                    logger_spec = logger_spec
+                    for key in default_logger_spec:
+                        if key not in logger_spec:
+                            logger_spec[key] = default_logger_spec[key]
+
+                # Set up the logger
+                configured['logger'] = set_up_logger(
+                    logging.getLogger('{}.{}'.format(func.__module__, func.__name__)),
+                    **logger_spec
+                )
+
+            kwargs['logger'] = configured['logger']
 
             return func(*args, **kwargs)
         return wrapper
@@ -198,6 +392,89 @@ def set_foundation(username, password):
                 print(line)
 
 
+def read_numbers(path, start=0, end=None):
+    """Streams numbers from a tab separated file, such as the counts file written by 'cm_word_count' when spilling to disk.
+
+    Args:
+        path (str): The path to the file. The numbers are in the last column.
+        start (int): The byte offset of the first line to read. Default: 0.
+        end (int): The byte offset to stop reading at. Default: None, the end of the file.
+
+    Yields:
+        int: The numbers.
+
+    """
+    with open(path, 'rb') as numbers_file:
+        numbers_file.seek(start)
+        position = start
+        for line in numbers_file:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield int(line.rstrip(b'\n').split(b'\t')[-1])
+
+
+def subdivide_file(path, subdivisions, whitespace=False):
+    """Segments a file into byte ranges that start and end on line boundaries, without reading it into memory.
+
+    Args:
+        path (str): The path to the file.
+        subdivisions (int): The number of ranges to return.
+        whitespace (bool): Split after any whitespace, rather than only at line ends, so a text file with long lines
+            still divides evenly. Default: False.
+
+    Returns:
+        list: A list of dicts, each with the 'file' and the 'start' and 'end' byte offsets of the range.
+
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+
+    boundaries = [0]
+    with open(path, 'rb') as subdivided_file:
+        for i in range(1, subdivisions):
+            # Move to just past the first line end (or whitespace) at or after the target offset.
+            subdivided_file.seek(max(size * i // subdivisions, boundaries[-1] + 1) - 1)
+            if whitespace:
+                boundary = size
+                while True:
+                    chunk = subdivided_file.read(65536)
+                    if len(chunk) == 0:
+                        break
+                    match = re.search(rb'\s', chunk)
+                    if match is not None:
+                        boundary = subdivided_file.tell() - len(chunk) + match.end()
+                        break
+            else:
+                subdivided_file.readline()
+                boundary = subdivided_file.tell()
+            if boundary >= size:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(size)
+
+    return [
+        {'file': path, 'start': start, 'end': end} for start, end in zip(boundaries[0:-1], boundaries[1:])
+    ]
+
+
+def segment_numbers(data):
+    """Gets the numbers for a segment, reading them from a file if the segment is a byte range from 'subdivide_file'.
+
+    Args:
+        data (list, dict): A list of numbers, or a byte range of a tab separated file.
+
+    Returns:
+        list: The numbers.
+
+    """
+    if isinstance(data, dict) and 'file' in data:
+        return list(read_numbers(data['file'], start=data['start'], end=data['end']))
+    return data
+
+
 def subdivide_list(full_list, subdivisions):
     """Segments a list into sub-lists.
 
@@ -4,6 +4,7 @@
 """
 
 import celery.schedules
+import kombu
 
 secrets = {
     'rabbitmq': {'user': 'clearmetal_app','password': 'set_me'}
@@ -16,10 +17,73 @@ logging = {
     },
     'app': {
         'file': 'logs/app.log',
-        'handler_type': 'auto_rotate'
+        # Records from every worker process go through one aggregator that writes them in batches of up to
+        # 'batch_size'. Processes outside a worker write to the file directly.
+        'handler_type': 'queue',
+        'batch_size': 100,
+        # Seconds a process waits to hand a record to the aggregator before writing it to the file itself.
+        'put_timeout': 1.0
     }
 }
 
+word_count = {
+    # Directory for the out-of-core mode of 'cm_word_count'. When set, each 'do' task spills sorted count runs here
+    # and 'collect' streams a k-way merge over them. Must be visible to every worker. None keeps everything in memory.
+    'spill_directory': None,
+    # The maximum number of distinct words a single process holds in memory before spilling a run to disk.
+    'memory_budget': 500000,
+    # The most run files merged at once, at least 2. More runs than this are merged in several passes.
+    'merge_fan_in': 64,
+    # The number of words to report in the top table.
+    'top_k': 100
+}
+
+stats = {
+    # The lower and upper edges of the fixed width histogram 'cm_stats' counts values into, unless the job gives its own
+    # 'bin_range'. None counts them into log scale buckets instead, which need no range up front.
+    'bin_range': None,
+    # The number of fixed width histogram bins.
+    'bins': 10,
+    # The ratio between the edges of consecutive log scale buckets.
+    'log_base': 2,
+    # The quantiles 'cm_stats' estimates.
+    'quantiles': [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99],
+    # The size of the quantile sketch. Quantiles are accurate to roughly 1 / sketch_size in rank.
+    'sketch_size': 200
+}
+
+scheduler = {
+    # The maximum number of segments of a single pipeline in flight on the 'app' queue at once. Can be overridden per
+    # pipeline with 'max_in_flight' in the task metadata.
+    'max_in_flight': 4,
+    # Priority classes, set per pipeline with 'priority' in the task metadata. Higher numbers are served first.
+    'priorities': {'high': 9, 'normal': 5, 'low': 1},
+    'default_priority': 'normal',
+    # Seconds a phase's queue of pending segments may go unused before the broker deletes it. It must be longer than
+    # the slowest segment takes to run.
+    'pending_expires': 86400
+}
+
+checkpoint = {
+    # Where to keep checkpoints of finished segments and phases: 'disk', 'memcached' or None to turn them off.
+    'backend': None,
+    # The directory used by the 'disk' backend.
+    'directory': 'checkpoints',
+    # The servers used by the 'memcached' backend.
+    'servers': ['127.0.0.1:11211']
+}
+
+shared_memory = {
+    # Move segment data through shared memory blocks instead of the broker when every worker is on this host. 'auto'
+    # asks the workers where they are, True always uses shared memory and False never does.
+    'enabled': 'auto',
+    # Seconds to wait for workers to say which queues they consume from.
+    'inspect_timeout': 0.5,
+    # Seconds to remember that the workers are not all on this host. That they are is only remembered for
+    # 'inspect_timeout' seconds, so a remote worker that joins is noticed before it is sent blocks it can't open.
+    'cache_seconds': 60
+}
+
 celery = {
     'broker_url': 'pyamqp://{}:{}@localhost:5672'.format(
         secrets['rabbitmq']['user'], secrets['rabbitmq']['password']
@@ -27,11 +91,17 @@ celery = {
     'task_annotations': {'celery.chord_unlock': {'queue': 'canvas'}},
     'result_backend': 'cache+memcached://127.0.0.1:11211/',
     'task_serializer': 'json',
+    'task_queues': [
+        kombu.Queue('app', routing_key='app', queue_arguments={'x-max-priority': 10}),
+        kombu.Queue('canvas', routing_key='canvas')
+    ],
+    # Only take one message at a time so higher priority messages are not stuck behind prefetched ones.
+    'worker_prefetch_multiplier': 1,
     'beat_schedule': {
         'word_count-pipeline': {
             'args': [
                 'moby_dick.txt', 
-                {'current_task': 'cm_word_count', 'all_tasks': ['cm_word_count', 'cm_add']}
+                {'current_task': 'cm_word_count', 'all_tasks': ['cm_word_count', 'cm_add'], 'priority': 'high'}
             ],
             # 'schedule': celery.schedules.crontab(minute=51, hour=8),
             'schedule': celery.schedules.crontab(minute='*/5'),
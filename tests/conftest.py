@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""Shared fixtures.
+
+"""
+
+import pytest
+
+import clearmetal.app
+
+
+@pytest.fixture(scope='module')
+def memory_app():
+    """Points the app at the in-memory broker and result backend for the tests in a module."""
+    conf = clearmetal.app.app.conf
+    original_conf = {'broker_url': conf.broker_url, 'result_backend': conf.result_backend}
+    conf.update(broker_url='memory://', result_backend='cache+memory://')
+
+    yield clearmetal.app.app
+
+    conf.update(**original_conf)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Tests for the checkpoint stores.
+
+"""
+
+import config
+import clearmetal.checkpoints
+
+
+def test_store_built_once_per_config(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.checkpoint, 'backend', 'disk')
+    monkeypatch.setitem(config.checkpoint, 'directory', str(tmp_path / 'a'))
+    store = clearmetal.checkpoints.get_store()
+    assert clearmetal.checkpoints.get_store() is store
+
+    monkeypatch.setitem(config.checkpoint, 'directory', str(tmp_path / 'b'))
+    assert clearmetal.checkpoints.get_store().directory == str(tmp_path / 'b')
+
+    monkeypatch.setitem(config.checkpoint, 'backend', None)
+    assert clearmetal.checkpoints.get_store() is None
+
+
+def test_input_fingerprint_follows_file_changes(tmp_path):
+    path = tmp_path / 'input.txt'
+    path.write_text(u'one two')
+    before = clearmetal.checkpoints.input_fingerprint(str(path))
+    assert clearmetal.checkpoints.input_fingerprint(str(path)) == before
+
+    path.write_text(u'one two three')
+    assert clearmetal.checkpoints.input_fingerprint(str(path)) != before
+    assert clearmetal.checkpoints.input_fingerprint([1, 2]) != clearmetal.checkpoints.input_fingerprint([1, 3])
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Tests for the asyncio client, run against an in-process worker on the in-memory broker and result backend.
+
+"""
+
+import asyncio
+import multiprocessing.shared_memory
+import os
+
+import celery.contrib.testing.worker
+import pytest
+
+import config
+import clearmetal.app
+import clearmetal.client
+import clearmetal.shared_segments
+
+moby_dick = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'moby_dick.txt')
+
+
+@pytest.fixture(scope='module')
+def worker(memory_app):
+    patched = [(config.shared_memory, 'enabled', False), (config.checkpoint, 'backend', None)]
+    originals = [(settings, key, settings[key]) for settings, key, _ in patched]
+    for settings, key, value in patched:
+        settings[key] = value
+
+    with celery.contrib.testing.worker.start_worker(
+            memory_app, pool='solo', perform_ping_check=False, loglevel='WARNING'
+    ) as test_worker:
+        yield test_worker
+
+    for settings, key, value in originals:
+        settings[key] = value
+
+
+def test_progress_and_final_result(worker):
+    async def run():
+        handle = await clearmetal.client.submit(
+            moby_dick, {'current_task': 'cm_word_count', 'all_tasks': ['cm_word_count', 'cm_add']}, poll_interval=0.05
+        )
+        phases = [phase async for phase in handle.progress(timeout=60)]
+        return phases, await handle
+
+    phases, final_result = asyncio.run(run())
+
+    assert [phase for phase, _ in phases] == ['cm_word_count', 'cm_add']
+    word_counts = phases[0][1]
+    assert final_result == sum(word_counts) == phases[1][1]
+
+
+def test_spilled_counts_removed_when_job_done(worker, tmp_path, monkeypatch):
+    monkeypatch.setitem(config.word_count, 'spill_directory', str(tmp_path))
+
+    async def run():
+        handle = await clearmetal.client.submit(
+            moby_dick, {'current_task': 'cm_word_count', 'all_tasks': ['cm_word_count', 'cm_add']}, poll_interval=0.05
+        )
+        phases = [phase async for phase in handle.progress(timeout=60)]
+        return phases, await handle
+
+    phases, final_result = asyncio.run(run())
+
+    counts_path = phases[0][1]
+    assert os.path.dirname(counts_path) == str(tmp_path)
+    assert final_result > 0
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_resubmitting_a_pipeline_id_ignores_the_earlier_run(worker):
+    async def run(task_data):
+        handle = await clearmetal.client.submit(
+            task_data, {'current_task': 'cm_add'}, segments=2, pipeline_id='resubmitted', poll_interval=0.05
+        )
+        return await handle.result(timeout=30)
+
+    # A failed run must not fail the next one either.
+    with pytest.raises(clearmetal.client.PipelineError):
+        asyncio.run(run(['a', 'b', 'c', 'd']))
+    assert asyncio.run(run([1, 2, 3, 4])) == 10
+    assert asyncio.run(run([10, 20, 30, 40])) == 100
+
+
+def test_failed_segment_raises(worker):
+    async def run():
+        # The prep succeeds, but every 'do' segment fails to subtract strings.
+        handle = await clearmetal.client.submit(
+            ['a', 'b', 'c', 'd'], {'current_task': 'cm_stats'}, segments=2, poll_interval=0.05
+        )
+        return await handle.result(timeout=30)
+
+    # Reported through the end task by 'fail_phase', not as a failure to start.
+    with pytest.raises(clearmetal.client.PipelineError, match='failed: '):
+        asyncio.run(run())
+
+
+def test_failed_phase_releases_shared_blocks(worker, monkeypatch):
+    monkeypatch.setitem(config.shared_memory, 'enabled', True)
+    shared = []
+    share_segments = clearmetal.shared_segments.share_segments
+
+    def record_blocks(concurrent_tasks):
+        concurrent_tasks, block_names = share_segments(concurrent_tasks)
+        shared.extend(block_names)
+        return concurrent_tasks, block_names
+
+    monkeypatch.setattr(clearmetal.shared_segments, 'share_segments', record_blocks)
+
+    async def run():
+        handle = await clearmetal.client.submit(
+            ['a', 'b', 'c', 'd'], {'current_task': 'cm_stats'}, segments=2, poll_interval=0.05
+        )
+        return await handle.result(timeout=30)
+
+    with pytest.raises(clearmetal.client.PipelineError):
+        asyncio.run(run())
+
+    assert len(shared) == 2
+    for name in shared:
+        with pytest.raises(FileNotFoundError):
+            multiprocessing.shared_memory.SharedMemory(name=name)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Tests for the out-of-core mode of the word count tasks.
+
+"""
+
+import collections
+import os
+import random
+
+import pytest
+
+import config
+import clearmetal.tasks.cm_add
+import clearmetal.tasks.cm_word_count
+import clearmetal.utilities
+
+
+def test_spilled_counts_chain_into_cm_add(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.word_count, 'spill_directory', str(tmp_path))
+    monkeypatch.setitem(config.word_count, 'memory_budget', 50)
+    monkeypatch.setitem(config.word_count, 'merge_fan_in', 8)
+
+    random.seed(0)
+    words = ['w{}'.format(random.randint(0, 3000)) for _ in range(20000)]
+    results = [clearmetal.tasks.cm_word_count.do(words[i::8], do_number=i) for i in range(8)]
+    assert sum(len(result['runs']) for result in results) > 8
+
+    counts_path = clearmetal.tasks.cm_word_count.collect(results)
+
+    # Only the counts file is left, and it holds every word once, in order.
+    assert os.listdir(str(tmp_path)) == [os.path.basename(counts_path)]
+    with open(counts_path, 'r', encoding='utf-8') as counts_file:
+        lines = [line.rstrip('\n').split('\t') for line in counts_file]
+    assert [word for word, _ in lines] == sorted(collections.Counter(words))
+    assert dict((word, int(count)) for word, count in lines) == collections.Counter(words)
+
+    segments = clearmetal.tasks.cm_add.prep(counts_path, segments=8)
+    assert all(isinstance(segment['args'][0], dict) for segment in segments)
+    total = clearmetal.tasks.cm_add.collect(
+        [clearmetal.tasks.cm_add.do(*segment['args'], **segment['kwargs']) for segment in segments]
+    )
+    assert total == len(words)
+
+
+def test_subdivide_file_keeps_every_line(tmp_path):
+    random.seed(0)
+    for size in [0, 1, 2, 5, 1000]:
+        numbers = [random.randint(0, 10 ** random.randint(0, 6)) for _ in range(size)]
+        path = str(tmp_path / 'counts-{}.tsv'.format(size))
+        with open(path, 'w', encoding='utf-8') as counts_file:
+            for i, number in enumerate(numbers):
+                counts_file.write(u'w{}\t{}\n'.format(i, number))
+
+        for subdivisions in [1, 3, 8, 50]:
+            ranges = clearmetal.utilities.subdivide_file(path, subdivisions)
+            assert len(ranges) <= subdivisions
+            assert [n for r in ranges for n in clearmetal.utilities.segment_numbers(r)] == numbers
+
+
+def test_reduce_runs_rejects_fan_in_below_two(tmp_path):
+    for fan_in in [None, 0, 1]:
+        with pytest.raises(ValueError, match='merge_fan_in'):
+            clearmetal.tasks.cm_word_count.reduce_runs(['a.run', 'b.run', 'c.run'], str(tmp_path), fan_in)
+
+
+def test_prep_segments_text_file_into_byte_ranges(tmp_path):
+    random.seed(0)
+    vocabulary = ['Whale,', 'sea', 'ship.', 'the', 'Ahab', 'harpoon!', u'café']
+    # One long line, so the ranges have to split on spaces rather than line ends.
+    text = u' '.join(random.choice(vocabulary) for _ in range(5000)) + u'\n' + u'sea\tship\n'
+    path = str(tmp_path / 'text.txt')
+    with open(path, 'w', encoding='utf-8') as text_file:
+        text_file.write(text)
+
+    segments = clearmetal.tasks.cm_word_count.prep(path, segments=8)
+    assert len(segments) == 8
+    assert all(isinstance(segment['args'][0], dict) for segment in segments)
+
+    results = [clearmetal.tasks.cm_word_count.do(*segment['args'], **segment['kwargs']) for segment in segments]
+    counts = collections.Counter()
+    for result in results:
+        counts.update(result['result'])
+    assert counts == collections.Counter(clearmetal.tasks.cm_word_count.clean_words(text))
+    assert sum(result['items_processed'] for result in results) == sum(counts.values())
+
+
+def test_failed_merge_removes_runs(tmp_path, monkeypatch):
+    monkeypatch.setitem(config.word_count, 'spill_directory', str(tmp_path))
+    monkeypatch.setitem(config.word_count, 'memory_budget', 10)
+    monkeypatch.setitem(config.word_count, 'merge_fan_in', 2)
+
+    results = [
+        clearmetal.tasks.cm_word_count.do(['w{}'.format(i % 37) for i in range(200)], do_number=0),
+        {'items_processed': 1, 'runs': [clearmetal.tasks.cm_word_count.write_run({'w9': 1}, str(tmp_path))]}
+    ]
+    # A corrupt run makes the merge fail partway through.
+    with open(results[1]['runs'][0], 'a', encoding='utf-8') as run_file:
+        run_file.write(u'not a count\n')
+
+    with pytest.raises(ValueError):
+        clearmetal.tasks.cm_word_count.collect(results)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Tests for the segment scheduler, run on the in-memory broker and result backend without a worker.
+
+Sending a signature is replaced with recording it, so each test runs the segments itself.
+
+"""
+
+import uuid
+
+import celery.app.task
+import celery.canvas
+import pytest
+
+import config
+import clearmetal.app
+import clearmetal.checkpoints
+import clearmetal.tasks.cm_add
+import clearmetal.tasks.main
+
+
+@pytest.fixture
+def sent(memory_app, monkeypatch):
+    monkeypatch.setitem(config.shared_memory, 'enabled', False)
+    monkeypatch.setitem(config.checkpoint, 'backend', None)
+    sent_signatures = []
+
+    def record(signature, args=None, kwargs=None, **options):
+        sent_signatures.append(signature.clone(kwargs=kwargs))
+
+    def record_task(task, args=None, kwargs=None, **options):
+        sent_signatures.append(task.s(*(args or []), **(kwargs or {})).set(**options))
+
+    monkeypatch.setattr(celery.canvas.Signature, 'apply_async', record)
+    monkeypatch.setattr(celery.canvas._chain, 'apply_async', record)
+    monkeypatch.setattr(celery.app.task.Task, 'apply_async', record_task)
+    return sent_signatures
+
+
+def segment_runs(sent_signatures):
+    return [s for s in sent_signatures if s.task == clearmetal.tasks.main.run_segment.name]
+
+
+def schedule(numbers, max_in_flight, priority=9):
+    pipeline_id = uuid.uuid4().hex
+    continuation = clearmetal.tasks.main.gather_segments.s(pipeline_id, 0, len(numbers))
+    clearmetal.tasks.main.schedule_segments(
+        [clearmetal.tasks.cm_add.do.s([n], do_number=i) for i, n in enumerate(numbers)],
+        continuation, max_in_flight, priority, pipeline_id, 0
+    )
+    return pipeline_id
+
+
+def run(segment_run):
+    return clearmetal.tasks.main.run_segment(*segment_run.args, **segment_run.kwargs)
+
+
+def test_only_max_in_flight_segments_sent_at_first(sent):
+    schedule(list(range(6)), max_in_flight=2)
+
+    assert [s.args[3] for s in segment_runs(sent)] == [0, 1]
+    assert all(s.options['priority'] == 9 for s in segment_runs(sent))
+    assert all('enqueued_at' in s.kwargs for s in segment_runs(sent))
+
+
+def test_finished_segment_releases_next_and_last_starts_continuation(sent):
+    pipeline_id = schedule([1, 2, 3, 4, 5], max_in_flight=2, priority=1)
+
+    finished = 0
+    while finished < len(segment_runs(sent)):
+        run(segment_runs(sent)[finished])
+        finished += 1
+        # Each finished segment sends one more until none are pending, so no more than two are ever in flight.
+        assert len(segment_runs(sent)) - finished <= 2
+
+    assert [s.args[3] for s in segment_runs(sent)] == [0, 1, 2, 3, 4]
+    assert all(s.options['priority'] == 1 for s in segment_runs(sent))
+
+    continuations = [s for s in sent if s.task == clearmetal.tasks.main.gather_segments.name]
+    assert len(continuations) == 1
+    results = clearmetal.tasks.main.gather_segments(*continuations[0].args)
+    assert [result['result'] for result in results] == [1, 2, 3, 4, 5]
+
+
+def test_no_segments_starts_continuation_straight_away(sent):
+    schedule([], max_in_flight=2)
+
+    assert segment_runs(sent) == []
+    assert [s.task for s in sent] == [clearmetal.tasks.main.gather_segments.name]
+
+
+def test_missing_scheduler_state_fails_loudly(sent):
+    pipeline_id = schedule([1, 2], max_in_flight=2)
+    clearmetal.app.app.backend.delete(clearmetal.tasks.main.scheduler_key(pipeline_id, 0, 'done'))
+
+    with pytest.raises(clearmetal.tasks.main.SchedulerError, match="'done'"):
+        run(segment_runs(sent)[0])
+
+
+@pytest.fixture
+def checkpoints(sent, tmp_path, monkeypatch):
+    monkeypatch.setitem(config.checkpoint, 'backend', 'disk')
+    monkeypatch.setitem(config.checkpoint, 'directory', str(tmp_path))
+    return clearmetal.checkpoints.get_store()
+
+
+def start_add(numbers, pipeline_id, segments=4, all_tasks=None):
+    task_metadata = {'current_task': 'cm_add', 'pipeline_id': pipeline_id, 'max_in_flight': segments}
+    if all_tasks is not None:
+        task_metadata['all_tasks'] = all_tasks
+    clearmetal.tasks.main.start_task(numbers, task_metadata, segments=segments)
+
+
+def finish_phase(sent_signatures, pipeline_id):
+    for segment_run in segment_runs(sent_signatures):
+        run(segment_run)
+    segments = len(segment_runs(sent_signatures))
+    results = clearmetal.tasks.main.gather_segments(pipeline_id, 0, segments)
+    return clearmetal.tasks.cm_add.collect(results)
+
+
+def interrupt_after_first_segment(sent_signatures, store, pipeline_id, numbers):
+    start_add(numbers, pipeline_id)
+    run(segment_runs(sent_signatures)[0])
+    del sent_signatures[:]
+
+    # Change the checkpoint so it's clear whether the resumed run used it.
+    key = clearmetal.checkpoints.segment_key(pipeline_id, 0, 0)
+    found, checkpoint = store.get(key)
+    assert found
+    store.set(key, dict(checkpoint, result=1000))
+
+
+def test_resume_skips_checkpointed_segments(sent, checkpoints):
+    pipeline_id = uuid.uuid4().hex
+    interrupt_after_first_segment(sent, checkpoints, pipeline_id, [1, 2, 3, 4])
+
+    start_add([1, 2, 3, 4], pipeline_id)
+    assert finish_phase(sent, pipeline_id) == 1000 + 2 + 3 + 4
+
+    # Gathering the phase drops its segment checkpoints.
+    assert checkpoints.get(clearmetal.checkpoints.segment_key(pipeline_id, 0, 0)) == (False, None)
+    assert checkpoints.get(clearmetal.checkpoints.manifest_key(pipeline_id, 0)) == (False, None)
+
+
+def test_resume_with_different_segments_discards_checkpoints(sent, checkpoints):
+    for numbers, segments in [([1, 2, 3, 4], 2), ([10, 20, 30, 40], 4)]:
+        del sent[:]
+        pipeline_id = uuid.uuid4().hex
+        interrupt_after_first_segment(sent, checkpoints, pipeline_id, [1, 2, 3, 4])
+
+        start_add(numbers, pipeline_id, segments=segments)
+        assert finish_phase(sent, pipeline_id) == sum(numbers)
+
+
+def test_resume_skips_checkpointed_phase_with_the_same_input(sent, checkpoints):
+    pipeline_id = uuid.uuid4().hex
+    checkpoints.set(
+        clearmetal.checkpoints.phase_key(pipeline_id, 0),
+        {'input_fingerprint': clearmetal.checkpoints.input_fingerprint([1, 2, 3, 4]), 'results': 1000}
+    )
+
+    start_add([1, 2, 3, 4], pipeline_id, all_tasks=['cm_add', 'cm_stats'])
+    assert segment_runs(sent) == []
+    assert [(s.task, s.args[0]) for s in sent] == [(clearmetal.tasks.main.end_task.name, 1000)]
+
+    del sent[:]
+    start_add([10, 20, 30, 40], pipeline_id, all_tasks=['cm_add', 'cm_stats'])
+    assert len(segment_runs(sent)) == 4
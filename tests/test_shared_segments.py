@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Tests for passing segment data through shared memory.
+
+"""
+
+import socket
+
+import config
+import clearmetal.app
+import clearmetal.shared_segments
+
+
+class Inspect(object):
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def active_queues(self):
+        return {'app@{}'.format(host): [{'name': 'app'}] for host in self.hosts}
+
+
+def test_positive_colocation_only_cached_for_inspect_timeout(monkeypatch):
+    monkeypatch.setitem(config.shared_memory, 'cache_seconds', 60)
+    monkeypatch.setitem(config.shared_memory, 'inspect_timeout', 0.5)
+    monkeypatch.setattr(clearmetal.shared_segments, 'colocation_cache', {'checked_at': None, 'colocated': False})
+    now = [1000.0]
+    monkeypatch.setattr(clearmetal.shared_segments.time, 'time', lambda: now[0])
+    hosts = [socket.gethostname()]
+    monkeypatch.setattr(clearmetal.app.app.control, 'inspect', lambda timeout: Inspect(hosts))
+
+    assert clearmetal.shared_segments.workers_colocated()
+
+    # A remote worker joins. It is noticed once the positive answer is older than the inspect timeout.
+    hosts.append('elsewhere')
+    now[0] += 0.1
+    assert clearmetal.shared_segments.workers_colocated()
+    now[0] += 0.5
+    assert not clearmetal.shared_segments.workers_colocated()
+
+    # A negative answer is kept for 'cache_seconds'.
+    hosts.remove('elsewhere')
+    now[0] += 30
+    assert not clearmetal.shared_segments.workers_colocated()
+    now[0] += 31
+    assert clearmetal.shared_segments.workers_colocated()
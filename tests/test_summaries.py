@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Tests for the mergeable summaries behind 'cm_stats'.
+
+"""
+
+import bisect
+import functools
+import random
+import statistics
+
+import pytest
+
+import clearmetal.summaries
+import clearmetal.tasks.cm_stats
+
+
+def split(values, pieces, rng):
+    cuts = sorted(rng.randint(0, len(values)) for _ in range(pieces - 1))
+    return [values[i:j] for i, j in zip([0] + cuts, cuts + [len(values)])]
+
+
+def test_merged_moments_match_a_single_pass():
+    rng = random.Random(0)
+    values = [rng.gauss(1000.0, 3.0) for _ in range(5000)]
+    segments = split(values, 7, rng) + [[]]
+    rng.shuffle(segments)
+
+    merged = functools.reduce(
+        clearmetal.summaries.merge_moments, [clearmetal.summaries.moments(segment) for segment in segments]
+    )
+    single = clearmetal.summaries.moments(values)
+
+    assert merged['count'] == single['count'] == len(values)
+    assert (merged['min'], merged['max']) == (min(values), max(values))
+    assert merged['mean'] == pytest.approx(statistics.fmean(values), rel=1e-12)
+    assert merged['m2'] / merged['count'] == pytest.approx(statistics.pvariance(values), rel=1e-9)
+    assert merged['m2'] == pytest.approx(single['m2'], rel=1e-9)
+
+
+def test_merged_sketch_rank_error_within_about_one_over_k():
+    k = 200
+    rng = random.Random(1)
+    values = [rng.expovariate(1.0) for _ in range(50000)]
+    sketches = [clearmetal.summaries.quantile_sketch(segment, k=k) for segment in split(values, 16, rng)]
+    sketch = functools.reduce(clearmetal.summaries.merge_quantile_sketches, sketches)
+
+    assert sketch['count'] == len(values)
+    assert sum(len(c) for c in sketch['compactors']) < 4 * k
+
+    ordered = sorted(values)
+    levels = [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+    for q, estimate in zip(levels, clearmetal.summaries.quantiles(sketch, levels)):
+        rank = bisect.bisect_right(ordered, estimate) / float(len(values))
+        assert abs(rank - q) <= 1.5 / k
+
+
+def test_sketch_is_deterministic():
+    values = [random.Random(2).random() for _ in range(10000)]
+    for _ in range(3):
+        random.seed()
+        assert clearmetal.summaries.quantile_sketch(values) == clearmetal.summaries.quantile_sketch(values)
+
+
+def test_histogram_edges_and_out_of_range_values():
+    summary = clearmetal.summaries.histogram([-1, 0, 0.5, 9.99, 10, 10.5], 0, 10, 5)
+
+    # The upper edge goes in the last bin.
+    assert summary['counts'] == [2, 0, 0, 0, 2]
+    assert (summary['underflow'], summary['overflow']) == (1, 1)
+    assert clearmetal.summaries.histogram_edges(summary) == [0, 2, 4, 6, 8, 10]
+
+    merged = clearmetal.summaries.merge_histograms(summary, clearmetal.summaries.histogram([], 0, 10, 5))
+    assert merged == summary
+
+
+def test_log_histogram_buckets_and_merges():
+    values = [0, 1, 2, 3, 4, 7, 8, 1000, 0.5, -1, -5, -0.25]
+    halves = [clearmetal.summaries.log_histogram(values[:5]), clearmetal.summaries.log_histogram(values[5:])]
+    merged = clearmetal.summaries.merge_log_histograms(*halves)
+
+    assert merged == clearmetal.summaries.log_histogram(values)
+    assert clearmetal.summaries.log_histogram_bins(merged) == [
+        [-8, -4, 1], [-2, -1, 1], [-0.5, -0.25, 1], [0, 0, 1], [0.5, 1, 1], [1, 2, 1], [2, 4, 2], [4, 8, 2],
+        [8, 16, 1], [512, 1024, 1]
+    ]
+    # Exact powers of the base start their bucket, however 'math.log' rounds.
+    for power in range(-30, 60):
+        assert clearmetal.summaries.log_bucket(2.0 ** power, 2) == power
+        assert clearmetal.summaries.log_bucket(10 ** abs(power), 10) == abs(power)
+
+
+def test_collect_with_empty_segments():
+    segments = [[], [3, 1, 2], [], [4]]
+    results = [clearmetal.tasks.cm_stats.do(segment, do_number=i) for i, segment in enumerate(segments)]
+    final_result = clearmetal.tasks.cm_stats.collect(results)
+
+    assert (final_result['count'], final_result['sum'], final_result['min'], final_result['max']) == (4, 10, 1, 4)
+    assert final_result['mean'] == 2.5
+    assert final_result['histogram']['bins'] == [[1, 2, 1], [2, 4, 2], [4, 8, 1]]
+
+    empty = clearmetal.tasks.cm_stats.collect([clearmetal.tasks.cm_stats.do([], do_number=0)])
+    assert empty['count'] == 0 and empty['mean'] is None and empty['quantiles']['0.5'] is None
+    assert empty['histogram']['bins'] == []
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Tests for the log aggregator.
+
+"""
+
+import logging
+import os
+
+import clearmetal.utilities
+
+
+def test_forked_children_log_through_aggregator(tmp_path):
+    logger_spec = {
+        'file': str(tmp_path / 'app.log'),
+        'format': '%(message)s',
+        'handler_type': 'queue',
+        'batch_size': 10
+    }
+    aggregator = clearmetal.utilities.get_log_aggregator(**logger_spec)
+    test_logger = clearmetal.utilities.set_up_logger(logging.getLogger('test_utilities.forked'), **logger_spec)
+    test_logger.propagate = False
+
+    # Logging before forking is what the pool's parent process does, so the children must still get through after it.
+    test_logger.info('parent')
+
+    children = []
+    for child in range(2):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(1000):
+                test_logger.info('child {} line {}'.format(child, i))
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        assert os.waitpid(pid, 0)[1] == 0
+
+    aggregator.stop()
+    assert logger_spec['file'] not in clearmetal.utilities.log_aggregators
+
+    with open(logger_spec['file'], 'r') as log_file:
+        lines = log_file.read().splitlines()
+    assert sorted(lines) == sorted(
+        ['parent'] + ['child {} line {}'.format(child, i) for child in range(2) for i in range(1000)]
+    )
+
+
+def test_stuck_queue_falls_back_to_the_file(tmp_path):
+    logger_spec = {
+        'file': str(tmp_path / 'app.log'),
+        'format': '%(message)s',
+        'handler_type': 'queue',
+        'put_timeout': 0.05
+    }
+    aggregator = clearmetal.utilities.get_log_aggregator(**logger_spec)
+    test_logger = clearmetal.utilities.set_up_logger(logging.getLogger('test_utilities.stuck'), **logger_spec)
+    test_logger.propagate = False
+
+    # As if another process had died holding the write lock.
+    aggregator.queue._wlock.acquire()
+    try:
+        test_logger.info('written directly')
+    finally:
+        aggregator.queue._wlock.release()
+    test_logger.info('through the aggregator')
+    aggregator.stop()
+
+    with open(logger_spec['file'], 'r') as log_file:
+        assert sorted(log_file.read().splitlines()) == ['through the aggregator', 'written directly']